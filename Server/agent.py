@@ -16,24 +16,55 @@
 
 from mesa import Agent
 from mesa.space import MultiGrid
+import heapq
 import math
+import time
 
 class PriorityQueue:
     """
-        Simple priority queue implementation.
+        Simple priority queue implementation on top of a binary heap. An
+        existing list can be given to reuse its storage between searches.
     """
-    def __init__(self):
-        self.elements = []
+    def __init__(self, elements=None):
+        self.elements = elements if elements is not None else []
 
     def empty(self):
         return len(self.elements) == 0
 
     def put(self, item, priority):
-        self.elements.append((priority, item))
-        self.elements.sort()  # Sort in ascending order
+        heapq.heappush(self.elements, (priority, item))
 
     def get(self):
-        return self.elements.pop(0)[1]  # Pop the element with the lowest priority
+        return heapq.heappop(self.elements)[1]  # Pop the element with the lowest priority
+
+class SearchBuffers:
+    """
+        Scratch storage reused by every A* search of a model, so steady-state
+        searches do not allocate new bookkeeping containers. Costs and parents
+        are kept in flat lists indexed by cell; a cell entry is only valid when
+        its stamp matches the current search generation, which avoids clearing
+        the lists between searches.
+    """
+    def __init__(self, width, height):
+        self.height = height
+        self.generation = 0
+        self.stamp = [0] * (width * height)
+        self.cost = [0.0] * (width * height)
+        self.came_from = [None] * (width * height)
+        self.frontier = []
+
+    def start(self):
+        """
+            Starts a new search, invalidating the entries of the previous one.
+        """
+        self.generation += 1
+        self.frontier.clear()
+
+def agent_number(unique_id):
+    """
+        Returns the number of an agent id such as "c_12".
+    """
+    return int(str(unique_id).rsplit('_', 1)[-1])
 
 def heuristic(a, b):
     """
@@ -43,28 +74,46 @@ def heuristic(a, b):
     (x2, y2) = b
     return math.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2)
 
-def a_star_search(grid_matrix: MultiGrid, start, goal, is_path_clear, block_cells=None):
+def a_star_search(grid_matrix: MultiGrid, start, goal, is_path_clear, block_cells=None, stats=None, buffers=None):
     """
         Modified A* search algorithm that finds the shortest path between two points on
         a grid. It takes into account the direction of the road when calculating
         the path and any blocking cells that should be avoided.
+
+        If a stats dictionary is given, the number of calls and node expansions
+        are added to its "calls" and "expansions" counters. If SearchBuffers are
+        given, the search works on them instead of allocating its own containers.
     """
-    frontier = PriorityQueue()
+    if buffers is None:
+        buffers = SearchBuffers(grid_matrix.width, grid_matrix.height)
+    buffers.start()
+    generation = buffers.generation
+    stamp = buffers.stamp
+    cost_so_far = buffers.cost
+    came_from = buffers.came_from
+    height = buffers.height
+
+    frontier = PriorityQueue(buffers.frontier)
     frontier.put(start, 0)
-    came_from = {start: None}
-    cost_so_far = {start: 0}
+    index = start[0] * height + start[1]
+    stamp[index] = generation
+    cost_so_far[index] = 0
+    came_from[index] = None
+    expansions = 0
 
     while not frontier.empty():
         current = frontier.get()
+        expansions += 1
 
         if current == goal:
             break
 
+        current_cost = cost_so_far[current[0] * height + current[1]]
         for next in get_neighbors(grid_matrix, current):
             if not is_path_clear(grid_matrix, current, next):
                 continue
 
-            new_cost = cost_so_far[current] + 1
+            new_cost = current_cost + 1
             dx = abs(next[0] - current[0])
             dy = abs(next[1] - current[1])
             if dx == 1 and dy == 1:
@@ -73,16 +122,22 @@ def a_star_search(grid_matrix: MultiGrid, start, goal, is_path_clear, block_cell
             if block_cells and next in block_cells:
                 new_cost += 1000
 
-            if next not in cost_so_far or new_cost < cost_so_far[next]:
-                cost_so_far[next] = new_cost
+            index = next[0] * height + next[1]
+            if stamp[index] != generation or new_cost < cost_so_far[index]:
+                stamp[index] = generation
+                cost_so_far[index] = new_cost
                 priority = new_cost + heuristic(goal, next)
                 frontier.put(next, priority)
-                came_from[next] = current
+                came_from[index] = current
+
+    if stats is not None:
+        stats["calls"] += 1
+        stats["expansions"] += expansions
 
     path = []
     while current != start:
         path.append(current)
-        current = came_from.get(current)
+        current = came_from[current[0] * height + current[1]]
     path.reverse()
 
     if not path:
@@ -92,6 +147,82 @@ def a_star_search(grid_matrix: MultiGrid, start, goal, is_path_clear, block_cell
     
     return path
 
+def reverse_search(grid_matrix: MultiGrid, goal, starts, is_path_clear, block_cells=None, stats=None, buffers=None):
+    """
+        Finds the shortest paths from several starts to the same goal with a
+        single search. It runs backwards from the goal over the same moves,
+        costs and blocking cells as a_star_search, guided by the distance to
+        the nearest start, and stops when every start has been reached.
+
+        Returns a dictionary mapping each start to its path (without the start,
+        ending at the goal), or to an empty list if the goal cannot be reached.
+        Stats and buffers are used as in a_star_search.
+    """
+    if buffers is None:
+        buffers = SearchBuffers(grid_matrix.width, grid_matrix.height)
+    buffers.start()
+    generation = buffers.generation
+    stamp = buffers.stamp
+    cost_so_far = buffers.cost
+    came_from = buffers.came_from  # Next cell towards the goal
+    height = buffers.height
+
+    def estimate(cell):
+        return min(heuristic(cell, start) for start in starts)
+
+    frontier = PriorityQueue(buffers.frontier)
+    frontier.put(goal, estimate(goal))
+    index = goal[0] * height + goal[1]
+    stamp[index] = generation
+    cost_so_far[index] = 0
+    came_from[index] = None
+    remaining = set(starts)
+    closed = set()
+    expansions = 0
+
+    while remaining and not frontier.empty():
+        current = frontier.get()
+        if current in closed:
+            continue
+        closed.add(current)
+        expansions += 1
+        remaining.discard(current)
+
+        current_cost = cost_so_far[current[0] * height + current[1]]
+        for previous in grid_matrix.get_neighborhood(current, moore=True, include_center=False):
+            # Same move as a forward search going from previous to current
+            if current not in get_neighbors(grid_matrix, previous) or not is_path_clear(grid_matrix, previous, current):
+                continue
+
+            new_cost = current_cost + 1
+            if previous[0] != current[0] and previous[1] != current[1]:
+                new_cost += math.sqrt(2) - 1
+
+            if block_cells and current in block_cells:
+                new_cost += 1000
+
+            index = previous[0] * height + previous[1]
+            if stamp[index] != generation or new_cost < cost_so_far[index]:
+                stamp[index] = generation
+                cost_so_far[index] = new_cost
+                frontier.put(previous, new_cost + estimate(previous))
+                came_from[index] = current
+
+    if stats is not None:
+        stats["calls"] += 1
+        stats["expansions"] += expansions
+
+    paths = {}
+    for start in starts:
+        path = []
+        if start in closed:
+            current = came_from[start[0] * height + start[1]]
+            while current is not None:
+                path.append(current)
+                current = came_from[current[0] * height + current[1]]
+        paths[start] = path
+    return paths
+
 def get_neighbors(grid: MultiGrid, pos):
     """
         Returns the neighbors of a cell based on the direction of the road.
@@ -146,6 +277,9 @@ class Car(Agent):
         destination: The destination the agent is trying to reach.
         path: A list of tuples representing the path to the destination.
         greediness: A measure of how proactive the agent is in route recalculations (0-1).
+        wait_steps: Number of consecutive steps the agent has not moved.
+        spawn_step, red_wait_steps, route_count: Trip statistics recorded when
+            the agent reaches its destination.
     """
     def __init__(self, unique_id, model, destination):
         super().__init__(unique_id, model)
@@ -154,54 +288,73 @@ class Car(Agent):
         self.greediness = self.random.random() # value between 0 and 1
         self.position_history = [] # Determines if the agent is stuck
         self.is_stuck = False
+        self.wait_steps = 0 # Steps since the agent last moved
+        self.spawn_step = model.schedule.steps
+        self.red_wait_steps = 0 # Steps spent stopped at red lights
+        self.route_count = 0 # Paths found, every one after the first is a reroute
 
-    def find_path(self, block_cells=None):
-        """ 
-        Finds the path to the destination using A* checking road directions.
+    def search_path(self, block_cells=None):
+        """
+        Runs A* from the current position to the destination checking road
+        directions. Returns the path without assigning it to the agent.
         """
         start = self.pos # Current position
         end = self.destination.get_position()
 
-        # Check if the path is clear
-        def is_path_clear(grid: MultiGrid, current_pos, next_pos):
-
-            next_cell_contents = grid.get_cell_list_contents([next_pos])
-            # Check if next cell is an obstacle (assuming obstacles are represented in a certain way)
-            for obj in next_cell_contents:
-                if isinstance(obj, Obstacle):
-                    return False
-                
-            # Cells that are not my destination are also obstacles (or buildings, etc.)
-            for obj in next_cell_contents:
-                if isinstance(obj, Destination) and obj != self.destination:
-                    return False
+        # Find the path using A* algorithm (block_cell is an optional parameter
+        # and will be passed as none if not provided)
+        started = time.perf_counter()
+        path = a_star_search(self.model.grid, start, end, self.is_path_clear, block_cells,
+                             self.model.search_stats, self.model.search_buffers)
+        self.model.metrics.astar_seconds.observe(time.perf_counter() - started)
+        return path
 
-            # Check for road directions
-            current_road = next(filter(lambda obj: isinstance(obj, Road), grid.get_cell_list_contents([current_pos])), None)
-            next_road = next(filter(lambda obj: isinstance(obj, Road), grid.get_cell_list_contents([next_pos])), None)
+    def is_path_clear(self, grid: MultiGrid, current_pos, next_pos):
+        """
+        Checks if the agent can move from current_pos to next_pos on its way
+        to its destination. Only depends on the destination, so every agent
+        going to the same one can share a search.
+        """
+        next_cell_contents = grid.get_cell_list_contents([next_pos])
+        # Check if next cell is an obstacle (assuming obstacles are represented in a certain way)
+        for obj in next_cell_contents:
+            if isinstance(obj, Obstacle):
+                return False
+            
+        # Cells that are not my destination are also obstacles (or buildings, etc.)
+        for obj in next_cell_contents:
+            if isinstance(obj, Destination) and obj != self.destination:
+                return False
 
-            if current_road:
-                return self.validate_road_direction(current_road, next_road, current_pos, next_pos)
+        # Check for road directions
+        current_road = next(filter(lambda obj: isinstance(obj, Road), grid.get_cell_list_contents([current_pos])), None)
+        next_road = next(filter(lambda obj: isinstance(obj, Road), grid.get_cell_list_contents([next_pos])), None)
 
-            # Path is clear if none of the above conditions are met
-            return True
-        
-        # Find the path using A* algorithm (block_cell is an optional parameter
-        # and will be passed as none if not provided)
-        self.path = a_star_search(self.model.grid, start, end, is_path_clear, block_cells)
+        if current_road:
+            return self.validate_road_direction(current_road, next_road, current_pos, next_pos)
 
-        if len(self.path) == 0:
-            print(f"Agent {self.unique_id} could not find a path to {end}, keeping current path.")
-            return # Don't update the path if no path was found
+        # Path is clear if none of the above conditions are met
+        return True
 
-        # Convert path to list of tuples and return it
-        return self.path
+    def request_replan(self, block_cells=None):
+        """
+            Queues a path recalculation in the model's replan queue instead of
+            running A* right away. The agent keeps its current path until the
+            queue serves the request.
+        """
+        self.model.replan_queue.request(self, block_cells)
     
     def update_position_history(self):
         """
             Updates the position history of the agent and checks if it is stuck
             based on the greediness of the agent.
         """
+        # Count how long the agent has been waiting on the same cell
+        if self.position_history and self.position_history[-1] == self.pos:
+            self.wait_steps += 1
+        else:
+            self.wait_steps = 0
+
         # Add the current position to the history
         self.position_history.append(self.pos)
 
@@ -257,13 +410,23 @@ class Car(Agent):
     def step(self):
         """ 
             Triggered at each step of the simulation. Moves the agent to the
-            next cell in the path and follows the subsumption architecture.
+            next cell in the path if no car is on it, see propose().
+        """
+        next_cell = self.propose(check_traffic=True)
+        if next_cell is not None:
+            self.move(next_cell)
+
+    def propose(self, check_traffic=False):
+        """
+            Follows the subsumption architecture and returns the cell the agent
+            wants to move to, or None if it stays.
 
             Subsumption architecture:
             1. Destination
             2. Traffic lights
-            3. Stuck: recalculate path before moving
-            4. Traffic
+            3. Stuck: queue a path recalculation, keep driving meanwhile
+            4. Traffic (only with check_traffic, the simultaneous activation
+               resolves it after every car has proposed its move)
             5. Road direction validation since the agent is moving
         """
         self.update_position_history()
@@ -273,19 +436,20 @@ class Car(Agent):
             if isinstance(obj, Destination):
                 if obj == self.destination:
                     print(f"Agent {self.unique_id} has arrived at its destination.")
+                    self.model.add_complete_trip(self)
+                    self.model.replan_queue.cancel(self)
                     self.model.grid.remove_agent(self)
                     self.model.schedule.remove(self)
-                    return
+                    return None
                 else:
                     print(f"Agent {self.unique_id} has arrived at a destination, but not its own.")
-                    self.path = []
-                    self.find_path(block_cells=[self.pos]) # Exclude the destination from the path
-                    return
+                    self.request_replan(block_cells=[self.pos]) # Exclude the destination from the path
+                    return None
                 
-        # If the path is empty, find a new path since no destination was found
+        # If the path is empty, queue a new path since no destination was found
         if len(self.path) == 0:
-            self.find_path()
-            return
+            self.request_replan()
+            return None
         
         next_cell = self.path[0]
         next_cell_contents = self.model.grid.get_cell_list_contents([next_cell])
@@ -294,38 +458,18 @@ class Car(Agent):
             # 2. Traffic lights
             traffic_light = next((obj for obj in next_cell_contents if isinstance(obj, Traffic_Light)), None)
             if traffic_light and not traffic_light.state:  # False = Red
-                return
+                self.red_wait_steps += 1
+                self.model.red_waits += 1
+                return None
         
-            # 3. Stuck: recalculate path before moving
+            # 3. Stuck: queue a path recalculation that avoids the blocking
+            # neighbor (next_cell); the queue serves it within its step budget
             if self.is_stuck:
-                self.path = []
-                # coordinates of the blocking neighbor is next_cell
-                self.find_path(block_cells = [next_cell])
-                if len(self.path) == 0:
-                    print(f"Agent {self.unique_id} could not find a path to {self.destination.get_position()}, keeping current path.")
-                    return
-                next_cell = self.path[0]
-                road = next((obj for obj in next_cell_contents if isinstance(obj, Road)), None) # this is an object
-
-                if road:
-                    next_road = next((obj for obj in self.model.grid.get_cell_list_contents([next_cell]) if isinstance(obj, Road)), None)
-
-                    # Validate the direction of the road
-                    correct_direction = self.validate_road_direction(road, next_road, self.pos, next_cell)
-
-                    if not correct_direction:
-                        self.path = []
-                        self.find_path(block_cells=[next_cell]) # Exclude the invalid cell from the path
-                        return
-
-                # All checks have passed, move to the next cell if exists
-                self.model.grid.move_agent(self, next_cell)
-                self.path.pop(0) # Remove the first element from the path since the agent has moved to that cell
-                return
+                self.request_replan(block_cells=[next_cell])
 
             # 4. Traffic
-            if any(isinstance(obj, Car) for obj in next_cell_contents):
-                return # Won't move if there is a car in the next cell
+            if check_traffic and any(isinstance(obj, Car) for obj in next_cell_contents):
+                return None # Won't move if there is a car in the next cell
             
             # 5. Road direction validation since the agent is moving
             road = next((obj for obj in next_cell_contents if isinstance(obj, Road)), None) # this is an object
@@ -338,15 +482,22 @@ class Car(Agent):
 
                 if not correct_direction:
                     self.path = []
-                    self.find_path(block_cells=[next_cell]) # Exclude the invalid cell from the path
-                    return
+                    self.request_replan(block_cells=[next_cell]) # Exclude the invalid cell from the path
+                    return None
 
             # All checks have passed, move to the next cell if exists
-            self.model.grid.move_agent(self, next_cell)
-            self.path.pop(0) # Remove the first element from the path since the agent has moved to that cell
+            return next_cell
         else:
             self.path = []
-            self.find_path()
+            self.request_replan()
+            return None
+
+    def move(self, next_cell):
+        """
+            Moves the agent to the next cell of its path.
+        """
+        self.model.grid.move_agent(self, next_cell)
+        self.path.pop(0) # Remove the first element from the path since the agent has moved to that cell
 
 class Traffic_Light(Agent):
     """
@@ -361,13 +512,27 @@ class Traffic_Light(Agent):
         axis: The axis along which the traffic light operates, determined by its initial state ('x' or 'y').
         direction: The direction the traffic light faces based on the adjacent roads.
         green_duration: The number of steps the traffic light remains green.
+
+    Class attributes (the default light policy, a model can override them per light):
+        green_steps: Steps the light stays green once it switches.
+        car_threshold: Cars waiting on compatible roads needed to switch to green.
+        sensing_radius: Radius of the Von Neumann neighborhood where cars are counted.
+        wave_period: Steps between the scheduled greens of a green wave, 0 disables it.
+        wave_offset: Delay of the scheduled green per cell travelled along the
+            light direction, so consecutive lights of a road turn green in sequence.
     """
+    green_steps = 4
+    car_threshold = 2
+    sensing_radius = 4
+    wave_period = 0
+    wave_offset = 0
+
     def __init__(self, unique_id, model, state = False):
         super().__init__(unique_id, model)
         self.state = state
         self.axis = "x" if state else "y"
         self.direction = None 
-        self.green_duration = 4 if state else 0
+        self.green_duration = self.green_steps if state else 0
 
     def set_direction(self, same_cell_road, adjacent_roads):
         """
@@ -438,6 +603,26 @@ class Traffic_Light(Agent):
         elif self.direction == 'Vertical':
             return road_direction in ['Up', 'Down']
         return True  # 'Any' direction
+    def is_wave_green(self):
+        """
+            Checks if a green wave schedules this light to turn green in the
+            current step. The schedule of each light is delayed by its distance
+            along its direction, so cars that leave a green light find the
+            following ones green too.
+        """
+        if not self.wave_period or not self.direction:
+            return False
+
+        x, y = self.pos
+        distances = {
+            "Right": x,
+            "Left": self.model.grid.width - 1 - x,
+            "Up": y,
+            "Down": self.model.grid.height - 1 - y,
+        }
+        offset = distances.get(self.direction, 0) * self.wave_offset
+        return (self.model.schedule.steps - offset) % self.wave_period == 0
+
     def step(self):
         """ 
             Changes the state of the traffic light based on the number of cars
@@ -464,8 +649,8 @@ class Traffic_Light(Agent):
         
         ## Smart traffic light
         car_count = 0
-        # Get the neighboring positions with a radius of 5
-        for pos in self.model.grid.get_neighborhood(self.pos, moore=False, include_center=False, radius=4):
+        # Get the neighboring positions within the sensing radius
+        for pos in self.model.grid.get_neighborhood(self.pos, moore=False, include_center=False, radius=self.sensing_radius):
             cell_contents = self.model.grid.get_cell_list_contents(pos)
 
             # Check for roads and their directions
@@ -474,10 +659,11 @@ class Traffic_Light(Agent):
                     # Count cars on this road
                     car_count += sum(isinstance(item, Car) for item in cell_contents)
 
-        # Check for 2+ cars and change the light to green
-        if car_count >= 2:
+        # Check for enough cars (2+ by default) or a scheduled green wave and
+        # change the light to green
+        if car_count >= self.car_threshold or self.is_wave_green():
             self.state = True
-            self.green_duration = 4  # Set the green light duration
+            self.green_duration = self.green_steps  # Set the green light duration
 
         # Decrement green light duration and change back to red if duration is over
         if self.state and self.green_duration > 0:
@@ -508,7 +694,8 @@ class Destination(Agent):
         cell = self.model.grid.get_cell_list_contents([self.pos])
         for agent in cell:
             if isinstance(agent, Car) and agent.destination == self:
-                self.model.add_complete_trip()
+                self.model.add_complete_trip(agent)
+                self.model.replan_queue.cancel(agent) # A stuck car may have queued a replan this step
                 self.model.grid.remove_agent(agent)
                 self.model.schedule.remove(agent)
 class Obstacle(Agent):
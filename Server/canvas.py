@@ -0,0 +1,44 @@
+"""
+    Canvas grid of the 2d Mesa view that caches the static layer. Mesa's
+    CanvasGrid calls the portrayal function for every agent of every cell on
+    each frame; this one portrays the roads, obstacles and destinations once
+    per model and only the traffic lights and cars on the following frames.
+
+    Imported only in 2d mode, since it loads Mesa's visualization.
+"""
+from collections import defaultdict
+from mesa.visualization import CanvasGrid
+from render import static_agents, dynamic_agents
+
+class LayeredCanvasGrid(CanvasGrid):
+    """
+    CanvasGrid that renders the static layer once per model.
+
+    Attributes:
+        static_model: Model the cached layer was built for, a new model
+            (e.g. after a reset) rebuilds it.
+        static_layers: Dictionary mapping layers to the cached portrayals.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.static_model = None
+        self.static_layers = {}
+
+    def portray(self, agents, layers):
+        for agent in agents:
+            portrayal = self.portrayal_method(agent)
+            if portrayal:
+                portrayal["x"], portrayal["y"] = agent.pos
+                layers[portrayal["Layer"]].append(portrayal)
+
+    def render(self, model):
+        if model is not self.static_model:
+            layers = defaultdict(list)
+            self.portray(static_agents(model), layers)
+            self.static_layers = dict(layers)
+            self.static_model = model
+
+        # Copies of the cached lists, the frame adds the moving agents to them
+        grid_state = defaultdict(list, {layer: list(portrayals) for layer, portrayals in self.static_layers.items()})
+        self.portray(dynamic_agents(model), grid_state)
+        return grid_state
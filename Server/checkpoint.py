@@ -0,0 +1,291 @@
+"""
+    Checkpoint, restore and fork of the city model. A checkpoint holds only the
+    dynamic state of a model (cars and their paths, traffic lights, spawn
+    queues, random generator, counters and step number); the map itself is
+    rebuilt from the city file, or shared with the parent model when forking
+    in process.
+
+    The serialized format is zlib-compressed JSON, so checkpoints received over
+    the network can be restored without executing anything.
+
+    Run as a script it checks the fork round trip under congestion: a model is
+    fed a constant demand and forked after every step, and the state of each
+    fork has to match the model's.
+
+    Arguments:
+        -s, --steps: Steps to run. Default is 1500.
+        -d, --demand: Cars per step requested at every spawn point. Default is 1.
+        -a, --activation: Activation mode of the model. Default is random.
+        -c, --city: City file to run. Default is ./city_files/2023_base.txt.
+        --seed: Random seed of the model. Default is 0.
+"""
+from collections import deque
+import argparse
+import json
+import os
+import sys
+import zlib
+from model import CityModel, city_path
+from agent import Car, Destination, Road
+import headless
+
+FORMAT_VERSION = 4
+
+# Largest decompressed checkpoint accepted by loads
+MAX_CHECKPOINT_BYTES = 16 * 1024 * 1024
+
+# CityModel arguments saved with a checkpoint, the only ones loads accepts from it
+SETTINGS_KEYS = ("activation", "spawn_points", "demand_profile", "max_occupancy")
+
+def model_settings(model):
+    """
+        Returns the CityModel arguments that configure the activation mode and
+        the spawn controller.
+    """
+    return {
+        "activation": model.activation,
+        "spawn_points": [list(point) for point in model.extra_spawn_points],
+        "demand_profile": model.spawner.demand_profile,
+        "max_occupancy": model.spawner.max_occupancy,
+    }
+
+def capture(model):
+    """
+        Returns the dynamic state of the model as plain data. Cars are listed
+        in schedule order, so a restored model activates them in the same order.
+    """
+    lights = [[light.unique_id, light.state, light.green_duration, light.direction]
+              for light in model.traffic_lights]
+
+    # The road under a light gets its direction from the light
+    light_roads = [[light.pos[0], light.pos[1], road.direction]
+                   for light in model.traffic_lights
+                   for road in model.grid.get_cell_list_contents([light.pos])
+                   if isinstance(road, Road)]
+
+    cars = [[car.unique_id, car.pos[0], car.pos[1], car.destination.unique_id,
+             [list(cell) for cell in car.path], car.greediness,
+             [list(cell) for cell in car.position_history], car.is_stuck, car.wait_steps,
+             car.spawn_step, car.red_wait_steps, car.route_count]
+            for car in model.schedule.agents if isinstance(car, Car)]
+
+    # Cars removed from the grid while waiting are skipped, the queue drops them
+    replans = [[car.unique_id, [list(cell) for cell in block_cells], requested_at]
+               for car, (block_cells, requested_at) in model.replan_queue.pending.items()
+               if car.pos is not None]
+
+    spawner = model.spawner
+    spawn = {
+        "queues": [list(queue) for queue in spawner.queues],
+        "credits": spawner.credits,
+    }
+
+    version, internal_state, gauss = model.random.getstate()
+    return {
+        "version": FORMAT_VERSION,
+        "city_file": model.city_file,
+        "step": model.schedule.steps,
+        "time": model.schedule.time,
+        "cycle": model.cycle,
+        "complete_trips": model.complete_trips,
+        "red_waits": model.red_waits,
+        "num_agents": model.num_agents,
+        "running": model.running,
+        "light_policy": model.light_policy,
+        "settings": model_settings(model),
+        "spawn": spawn,
+        "random": [version, list(internal_state), gauss],
+        "lights": lights,
+        "light_roads": light_roads,
+        "cars": cars,
+        "replans": replans,
+    }
+
+def restore(model, state):
+    """
+        Replaces the dynamic state of a model built from the same city file
+        with a captured state.
+    """
+    if state.get("version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported checkpoint version: {state.get('version')}")
+    if os.path.basename(state["city_file"]) != os.path.basename(model.city_file):
+        raise ValueError(f"Checkpoint of {state['city_file']} cannot be restored on {model.city_file}")
+
+    # Remove the current cars
+    for car in [agent for agent in model.schedule.agents if isinstance(agent, Car)]:
+        model.grid.remove_agent(car)
+        model.schedule.remove(car)
+    model.replan_queue.pending.clear()
+
+    lights = {light.unique_id: light for light in model.traffic_lights}
+    for unique_id, light_state, green_duration, direction in state["lights"]:
+        light = lights[unique_id]
+        light.state = light_state
+        light.green_duration = green_duration
+        light.direction = direction
+
+    for x, y, direction in state["light_roads"]:
+        for road in model.grid.get_cell_list_contents([(x, y)]):
+            if isinstance(road, Road):
+                road.direction = direction
+
+    destinations = {agent.unique_id: agent for agent in model.schedule.agents if isinstance(agent, Destination)}
+    cars = {}
+    for (unique_id, x, y, destination_id, path, greediness, history, is_stuck, wait_steps,
+         spawn_step, red_wait_steps, route_count) in state["cars"]:
+        car = Car(unique_id, model, destinations[destination_id])
+        car.path = [tuple(cell) for cell in path]
+        car.greediness = greediness
+        car.position_history = [tuple(cell) for cell in history]
+        car.is_stuck = is_stuck
+        car.wait_steps = wait_steps
+        car.spawn_step = spawn_step
+        car.red_wait_steps = red_wait_steps
+        car.route_count = route_count
+        model.grid.place_agent(car, (x, y))
+        model.schedule.add(car)
+        cars[unique_id] = car
+
+    for unique_id, block_cells, requested_at in state["replans"]:
+        model.replan_queue.pending[cars[unique_id]] = (tuple(tuple(cell) for cell in block_cells), requested_at)
+
+    model.schedule.steps = state["step"]
+    model.schedule.time = state["time"]
+    model.cycle = state["cycle"]
+    model.complete_trips = state["complete_trips"]
+    model.red_waits = state["red_waits"]
+    model.num_agents = state["num_agents"]
+    model.running = state["running"]
+    model.apply_light_policy(state.get("light_policy") or {})
+
+    spawner = model.spawner
+    if len(state["spawn"]["queues"]) != len(spawner.queues):
+        raise ValueError("Checkpoint spawn points do not match the model")
+    spawner.queues = [deque(queue) for queue in state["spawn"]["queues"]]
+    spawner.credits = list(state["spawn"]["credits"])
+
+    # Creating the cars draws from the generator, so its state goes last
+    version, internal_state, gauss = state["random"]
+    model.random.setstate((version, tuple(internal_state), gauss))
+    return model
+
+def dumps(model):
+    """
+        Serializes the dynamic state of the model.
+    """
+    return zlib.compress(json.dumps(capture(model), separators=(',', ':')).encode())
+
+def decompress(data):
+    """
+        Decompresses a checkpoint, refusing the ones that would expand past
+        MAX_CHECKPOINT_BYTES.
+    """
+    decompressor = zlib.decompressobj()
+    raw = decompressor.decompress(data, MAX_CHECKPOINT_BYTES)
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Checkpoint larger than {MAX_CHECKPOINT_BYTES} bytes")
+    if not decompressor.eof:
+        raise ValueError("Truncated checkpoint")
+    return raw
+
+def loads(data, endpoint=None, periodicity=60, **kwargs):
+    """
+        Builds a new model from a serialized checkpoint. Extra keyword
+        arguments are passed to CityModel. The map is looked up by its file
+        name in the city files directory (see city_path), whatever path the
+        checkpoint names.
+    """
+    state = json.loads(decompress(data))
+    settings = state.get("settings", {})
+    kwargs = dict({key: settings[key] for key in SETTINGS_KEYS if key in settings}, **kwargs)
+    model = CityModel(endpoint=endpoint, periodicity=periodicity, city_file=city_path(state["city_file"]), **kwargs)
+    return restore(model, state)
+
+def fork(model):
+    """
+        Returns an independent copy of the model that shares its roads and
+        obstacles and copies only the dynamic state. The fork starts with the
+        same random state, so both continue identically until they are changed.
+    """
+    clone = CityModel(endpoint=None, periodicity=model.periodicity,
+                      replan_time_budget=model.replan_queue.time_budget,
+                      replan_expansion_budget=model.replan_queue.expansion_budget,
+                      city_file=model.city_file, static_source=model, light_policy=model.light_policy,
+                      **model_settings(model))
+    return restore(clone, capture(model))
+
+def run_branch(data, branch, steps):
+    """
+        Restores a checkpoint, applies the branch (a callable that changes the
+        model, or None) and runs it headless. Returns the outcome of the run.
+        The replan queue only uses its expansion budget, so runs are reproducible.
+    """
+    model = loads(data, replan_time_budget=None)
+    trips = model.complete_trips
+    if branch is not None:
+        branch(model)
+    headless.run(model, steps)
+    return {
+        "steps": steps,
+        "complete_trips": model.complete_trips - trips,
+        "cars": model.get_car_count(),
+        "running": model.running,
+    }
+
+def evaluate_branches(model, branches, steps, processes=None):
+    """
+        Runs each branch from the current state of the model for the given
+        number of steps in parallel processes. Every branch starts from the
+        same checkpoint and random state. Branches must be picklable (module
+        level functions or functools.partial of them). Returns the outcomes
+        in the order of the branches.
+    """
+    from concurrent.futures import ProcessPoolExecutor  # Loads multiprocessing, only needed here
+    data = dumps(model)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(run_branch, data, branch, steps) for branch in branches]
+        return [future.result() for future in futures]
+
+def check_forks(model, steps):
+    """
+        Steps the model and forks it after every step. Returns the steps at
+        which the fork could not be made or its state differs from the model's.
+    """
+    failures = []
+    for _ in range(steps):
+        headless.run(model, 1)
+        step = model.schedule.steps
+        try:
+            matches = capture(fork(model)) == capture(model)
+        except (KeyError, ValueError) as error:
+            print(f"Step {step}: fork failed ({type(error).__name__} {error})")
+            failures.append(step)
+            continue
+        if not matches:
+            print(f"Step {step}: the fork state differs from the model")
+            failures.append(step)
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fork round trip check of the traffic model.')
+    parser.add_argument('-s', '--steps', type=int, default=1500,
+                        help='Steps to run. Default is 1500.')
+    parser.add_argument('-d', '--demand', type=float, default=1.0,
+                        help='Cars per step requested at every spawn point. Default is 1.')
+    parser.add_argument('-a', '--activation', type=str, default='random',
+                        help='Activation mode of the model. Default is random.')
+    parser.add_argument('-c', '--city', type=str, default='./city_files/2023_base.txt',
+                        help='City file to run. Default is ./city_files/2023_base.txt.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed of the model. Default is 0.')
+    args = parser.parse_args()
+
+    model = CityModel(endpoint=None, periodicity=args.steps + 1, city_file=args.city, seed=args.seed,
+                      replan_time_budget=None, activation=args.activation,
+                      demand_profile={"segments": [[0, args.demand]]})
+    failures = check_forks(model, args.steps)
+    print(f"{args.steps} steps, {model.get_car_count()} cars at the end, {len(failures)} failed forks")
+    if failures:
+        print("FAILED")
+        sys.exit(1)
+    print("PASSED")
@@ -0,0 +1,203 @@
+"""
+    Columnar collector of the throughput metrics of the city simulation. Every
+    step and every completed trip is written as one row into preallocated typed
+    array columns; when a chunk fills up it is kept in memory for windowed queries
+    and, if an output directory is given, written to a Parquet file. The chunks
+    kept in memory are reused as a ring, so a long run does not grow it past
+    keep_chunks + 1 chunks. Chunks are only allocated when they are first
+    written, so short runs and forks stay small.
+
+    Recording a row is a handful of array assignments, unlike Mesa's
+    DataCollector that calls a reporter per variable (and per agent) and
+    stores Python lists of dictionaries.
+"""
+from array import array
+from collections import deque
+import os
+from agent import agent_number
+
+# Columns of the per-step and per-trip tables and their array type codes
+STEP_COLUMNS = (("step", "q"), ("cars", "i"), ("spawned", "i"), ("trips", "i"),
+                ("waiting_at_red", "i"), ("replans", "i"), ("step_seconds", "d"))
+TRIP_COLUMNS = (("car", "q"), ("spawn_step", "q"), ("arrival_step", "q"),
+                ("travel_steps", "i"), ("red_wait_steps", "i"), ("reroutes", "i"))
+
+class ColumnBuffer:
+    """
+    Fixed-size set of columns filled row by row. Full chunks are kept in a
+    bounded in-memory history and optionally written to Parquet. The chunk
+    being written and the history share a ring of keep_chunks + 1 chunks,
+    each allocated the first time it is written, so memory stops growing
+    once the ring is full.
+
+    Attributes:
+        name: Name of the table, used for the chunk file names.
+        columns: Dictionary mapping column names to the arrays of the current
+            chunk, None until its first row.
+        rows: Rows written in the current chunk.
+        chunks: Last flushed chunks kept in memory for queries, as (columns, rows).
+    """
+    def __init__(self, name, columns, chunk_size, keep_chunks, output_dir=None):
+        self.name = name
+        self.types = columns
+        self.chunk_size = chunk_size
+        self.output_dir = output_dir
+        self.ring = [None] * (keep_chunks + 1)
+        self.current = 0  # Index of the chunk being written in the ring
+        self.columns = None
+        self.rows = 0
+        self.chunks = deque(maxlen=keep_chunks)
+        self.flushed = 0  # Chunks written so far
+
+    def allocate(self):
+        return {name: array(typecode, [0]) * self.chunk_size for name, typecode in self.types}
+
+    def append(self, *values):
+        if self.columns is None:
+            self.columns = self.ring[self.current] = self.allocate()
+        row = self.rows
+        for (name, _), value in zip(self.types, values):
+            self.columns[name][row] = value
+        self.rows = row + 1
+        if self.rows == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+            Moves the rows written so far to the chunk history and the output
+            directory, and starts a new chunk in the next slot of the ring,
+            which holds the oldest chunk of the history (dropped from it).
+        """
+        if not self.rows:
+            return
+        self.chunks.append((self.columns, self.rows))
+        if self.output_dir:
+            write_parquet(self.columns, self.rows, self.types,
+                          os.path.join(self.output_dir, f"{self.name}-{self.flushed:06d}.parquet"))
+        self.flushed += 1
+        self.current = (self.current + 1) % len(self.ring)
+        self.columns = self.ring[self.current]
+        self.rows = 0
+
+    def dropped(self):
+        """
+            Checks if flushed chunks have already left the history.
+        """
+        return self.flushed > len(self.chunks)
+
+    def column(self, name):
+        """
+            Returns a column over the retained chunks and the current partial
+            chunk, oldest rows first.
+        """
+        values = array(dict(self.types)[name])
+        for chunk, rows in self.chunks:
+            values.extend(chunk[name][:rows])
+        if self.rows:
+            values.extend(self.columns[name][:self.rows])
+        return values
+
+def write_parquet(chunk, rows, types, path):
+    """
+        Writes the first rows of a chunk of columns to a Parquet file without
+        copying them. pyarrow is only needed when an output directory is used.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    arrow_types = {"q": pa.int64(), "i": pa.int32(), "d": pa.float64()}
+    table = pa.table({name: pa.Array.from_buffers(arrow_types[typecode], rows, [None, pa.py_buffer(chunk[name])])
+                      for name, typecode in types})
+    pq.write_table(table, path)
+
+def mean(values):
+    return sum(values) / len(values) if values else None
+
+def percentile(values, q):
+    """
+        Nearest-rank percentile of the values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+class TripCollector:
+    """
+    Records one row per model step and one row per completed trip.
+
+    Attributes:
+        steps: Per-step table (cars, spawned cars, completed trips, cars
+            stopped at a red light, served replans and step time).
+        trips: Per-trip table (spawn and arrival step, travel time, steps
+            waiting at red lights and reroutes).
+    """
+    def __init__(self, chunk_size=4096, keep_chunks=16, output_dir=None):
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        self.steps = ColumnBuffer("steps", STEP_COLUMNS, chunk_size, keep_chunks, output_dir)
+        self.trips = ColumnBuffer("trips", TRIP_COLUMNS, chunk_size, keep_chunks, output_dir)
+
+    def record_step(self, step, cars, spawned, trips, waiting_at_red, replans, seconds):
+        self.steps.append(step, cars, spawned, trips, waiting_at_red, replans, seconds)
+
+    def record_trip(self, car, arrival_step):
+        self.trips.append(agent_number(car.unique_id), car.spawn_step, arrival_step,
+                          arrival_step - car.spawn_step, car.red_wait_steps, max(car.route_count - 1, 0))
+
+    def flush(self):
+        self.steps.flush()
+        self.trips.flush()
+
+    def select(self, table, key, start, end, names):
+        """
+            Returns the given columns of the rows whose key column is in [start, end).
+        """
+        keys = table.column(key)
+        rows = [index for index, value in enumerate(keys) if start <= value < end]
+        columns = {}
+        for name in names:
+            column = table.column(name)
+            columns[name] = [column[index] for index in rows]
+        return columns
+
+    def query(self, start, end):
+        """
+            Summarizes the steps in [start, end) and the trips that arrived in
+            them. Only the chunks kept in memory can be queried. The two tables
+            drop rows at different rates, so the range is clipped to the steps
+            whose step and trip rows are all still held, and the clipped bounds
+            are returned.
+        """
+        recorded = self.steps.column("step")
+        if recorded:
+            start, end = max(start, recorded[0]), min(end, recorded[-1] + 1)
+            arrivals = self.trips.column("arrival_step")
+            if self.trips.dropped() and arrivals:
+                # The oldest step with trips held may have lost some of them
+                start = max(start, arrivals[0] + 1)
+        else:
+            end = start
+        end = max(start, end)
+        steps = self.select(self.steps, "step", start, end,
+                            ("cars", "spawned", "waiting_at_red", "replans", "step_seconds"))
+        trips = self.select(self.trips, "arrival_step", start, end,
+                            ("travel_steps", "red_wait_steps", "reroutes"))
+        step_count = len(steps["cars"])
+        trip_count = len(trips["travel_steps"])
+        return {
+            "start": start,
+            "end": end,
+            "steps": step_count,
+            "trips": trip_count,
+            "tripsPerStep": trip_count / step_count if step_count else None,
+            "spawned": sum(steps["spawned"]),
+            "meanCars": mean(steps["cars"]),
+            "meanWaitingAtRed": mean(steps["waiting_at_red"]),
+            "replans": sum(steps["replans"]),
+            "meanStepSeconds": mean(steps["step_seconds"]),
+            "meanTravelSteps": mean(trips["travel_steps"]),
+            "p50TravelSteps": percentile(trips["travel_steps"], 50),
+            "p95TravelSteps": percentile(trips["travel_steps"], 95),
+            "meanRedWaitSteps": mean(trips["red_wait_steps"]),
+            "meanReroutes": mean(trips["reroutes"]),
+        }
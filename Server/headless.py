@@ -0,0 +1,27 @@
+"""
+    Helpers to run the city model without a server: the model prints on every
+    step, which dominates the run time of long or parallel runs, so the output
+    is discarded while stepping.
+"""
+import contextlib
+import os
+
+@contextlib.contextmanager
+def quiet():
+    """
+        Discards everything printed inside the block.
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def run(model, steps, on_step=None):
+    """
+        Steps the model the given number of times without printing. If given,
+        on_step is called with the model after each step. Returns the model.
+    """
+    with quiet():
+        for _ in range(steps):
+            model.step()
+            if on_step:
+                on_step(model)
+    return model
@@ -0,0 +1,234 @@
+"""
+    This file contains the instrumentation of the city simulation: counters,
+    gauges and histograms that are cheap enough to update every step and can be
+    rendered in the Prometheus text format, plus an on-demand cProfile capture.
+"""
+from bisect import bisect_left
+import io
+import time
+
+# Upper bounds (in seconds) of the timing histogram buckets, from 10 µs to 5 s
+TIME_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# Upper bounds of the histogram buckets used for counts (A* expansions, etc.)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def format_labels(label_name, label_value, extra=""):
+    """
+        Formats a Prometheus label set, returns an empty string if there are no labels.
+    """
+    labels = []
+    if label_name is not None:
+        labels.append(f'{label_name}="{label_value}"')
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+class Counter:
+    """
+    Monotonic counter, optionally split by the value of a single label.
+    """
+    kind = "counter"
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, amount=1, label_value=None):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def get(self, label_value=None):
+        return self.values.get(label_value, 0)
+
+    def samples(self):
+        for label_value, value in self.values.items():
+            yield f"{self.name}{format_labels(self.label, label_value)} {value}"
+
+class Gauge(Counter):
+    """
+    Value that can go up and down, optionally split by a single label.
+    """
+    kind = "gauge"
+
+    def set(self, value, label_value=None):
+        self.values[label_value] = value
+
+class Histogram:
+    """
+    Fixed-bucket histogram, optionally split by the value of a single label.
+    Observing a value is a binary search plus two additions, so it can be used
+    inside the simulation step.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.children = {}  # label value -> [bucket counts, sum, count]
+
+    def observe(self, value, label_value=None):
+        child = self.children.get(label_value)
+        if child is None:
+            child = self.children[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        child[0][bisect_left(self.buckets, value)] += 1
+        child[1] += value
+        child[2] += 1
+
+    def count(self, label_value=None):
+        child = self.children.get(label_value)
+        return child[2] if child else 0
+
+    def total(self, label_value=None):
+        child = self.children.get(label_value)
+        return child[1] if child else 0.0
+
+    def samples(self):
+        for label_value, (counts, total, count) in self.children.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = format_labels(self.label, label_value, 'le="%s"' % bound)
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            bucket_labels = format_labels(self.label, label_value, 'le="+Inf"')
+            yield f"{self.name}_bucket{bucket_labels} {count}"
+            yield f"{self.name}_sum{format_labels(self.label, label_value)} {total}"
+            yield f"{self.name}_count{format_labels(self.label, label_value)} {count}"
+
+class MetricsRegistry:
+    """
+    Collection of metrics that renders itself in the Prometheus text exposition format.
+    """
+    def __init__(self, prefix="swiftcars_"):
+        self.prefix = prefix
+        self.metrics = {}
+
+    def register(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label=None):
+        return self.register(Counter(name, help, label))
+
+    def gauge(self, name, help, label=None):
+        return self.register(Gauge(name, help, label))
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS, label=None):
+        return self.register(Histogram(name, help, buckets, label))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+class StepMetrics(MetricsRegistry):
+    """
+    Metrics recorded by the city model on every step.
+
+    Attributes:
+        phase_seconds: Time spent in each phase of the step (spawn, replan,
+            cars, lights, destinations, post).
+        step_seconds: Total time of each step.
+        astar_seconds: Time of each A* search.
+        astar_calls, astar_expansions, astar_cache_hits: A* counters, a cache
+            hit is a path reused from a batched search of the replan queue.
+        astar_expansions_per_step: Node expansions in each step.
+        replans_requested, replans_served: Replan queue counters.
+        replan_queue_length: Requests waiting after the step.
+        stuck_cars: Cars flagged as stuck during the step.
+        move_conflicts: Cars that lost a cell to another car in the
+            simultaneous activation.
+        spawns_demanded, spawns_admitted, spawns_dropped: Spawn controller
+            counters, dropped demand did not fit in a full spawn queue.
+        spawn_queue_length: Cars waiting to enter at each spawn point.
+        cars: Cars in the simulation after the step.
+        complete_trips: Trips completed so far.
+        steps: Steps executed.
+    """
+    def __init__(self):
+        super().__init__()
+        self.phase_seconds = self.histogram("step_phase_seconds", "Time spent in each phase of a model step.", label="phase")
+        self.step_seconds = self.histogram("step_seconds", "Total time of a model step.")
+        self.astar_seconds = self.histogram("astar_seconds", "Time of a single A* search.")
+        self.astar_calls = self.counter("astar_calls_total", "A* searches executed.")
+        self.astar_expansions = self.counter("astar_expansions_total", "A* node expansions.")
+        self.astar_cache_hits = self.counter("astar_cache_hits_total", "Paths reused from a batched search instead of running A*.")
+        self.astar_expansions_per_step = self.histogram("astar_expansions_per_step", "A* node expansions in a model step.", COUNT_BUCKETS)
+        self.replans_requested = self.counter("replans_requested_total", "Path recalculations queued by cars.")
+        self.replans_served = self.counter("replans_served_total", "Path recalculations served by the replan queue.")
+        self.replan_queue_length = self.gauge("replan_queue_length", "Path recalculations waiting in the replan queue.")
+        self.spawns_demanded = self.counter("spawns_demanded_total", "Cars requested by the demand profile.")
+        self.spawns_admitted = self.counter("spawns_admitted_total", "Cars admitted into the simulation.")
+        self.spawns_dropped = self.counter("spawns_dropped_total", "Cars dropped because their spawn queue was full.")
+        self.spawn_queue_length = self.gauge("spawn_queue_length", "Cars waiting to enter at each spawn point.", label="point")
+        self.move_conflicts = self.counter("move_conflicts_total", "Cars that lost a cell to another car in the simultaneous activation.")
+        self.stuck_cars = self.gauge("stuck_cars", "Cars flagged as stuck in the last step.")
+        self.cars = self.gauge("cars", "Cars in the simulation.")
+        self.complete_trips = self.gauge("complete_trips", "Trips completed so far.")
+        self.steps = self.counter("steps_total", "Model steps executed.")
+
+class PhaseTimer:
+    """
+    Context manager that adds the time spent in its block to a phase of a histogram.
+    """
+    __slots__ = ("histogram", "phase", "started")
+
+    def __init__(self, histogram, phase):
+        self.histogram = histogram
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, self.phase)
+        return False
+
+class ProfileCapture:
+    """
+    On-demand cProfile capture. Once armed, the next given number of calls to
+    run() are profiled together and the report is kept until the next capture.
+    cProfile and pstats are only imported when a capture is armed.
+    """
+    def __init__(self):
+        self.remaining = 0
+        self.profiler = None
+        self.report_text = None
+
+    def arm(self, calls):
+        import cProfile
+        self.remaining = calls
+        self.profiler = cProfile.Profile()
+
+    def is_armed(self):
+        return self.remaining > 0
+
+    def run(self, function, *args, **kwargs):
+        if not self.remaining:
+            return function(*args, **kwargs)
+
+        self.profiler.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.profiler.disable()
+            self.remaining -= 1
+            if not self.remaining:
+                self.report_text = self.report(self.profiler)
+                self.profiler = None
+
+    @staticmethod
+    def report(profiler, sort="cumulative", limit=40):
+        import pstats
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
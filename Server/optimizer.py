@@ -0,0 +1,134 @@
+"""
+    Offline optimizer of the traffic light policy. Samples light policies
+    (car threshold, green duration, sensing radius and green wave period and
+    offset), evaluates each one with headless runs of the city model in
+    parallel processes and keeps the one with the most completed trips per
+    step on each city file.
+
+    Every candidate is run with the same seeds (common random numbers), so the
+    differences between candidates come from the policy and not from the
+    random spawns and activation order.
+
+    The best policy of each city is written to <output>/<city>.json, which can
+    be loaded at /init with {"lightPolicy": "<city>.json"}.
+
+    Arguments:
+        -c, --city: City files to optimize. Default is every city_files/*_base.txt.
+        -n, --candidates: Random policies evaluated besides the default one. Default is 40.
+        -s, --steps: Steps of each run. Default is 1000.
+        -r, --seeds: Seeds (runs) per candidate. Default is 4.
+        -p, --processes: Worker processes. Default is the number of CPUs.
+        -o, --output: Directory of the policy files. Default is city_files/policies.
+        --stats-dir: Directory where the per-step and per-trip tables of every run are
+            written as Parquet, in <city>/policy-<n>-seed-<seed> subdirectories.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import glob
+import json
+import os
+import random
+from model import CityModel, default_light_policy
+import headless
+from collector import TripCollector
+
+# Values sampled for each setting of a light policy
+SEARCH_SPACE = {
+    "car_threshold": [1, 2, 3, 4],
+    "green_steps": [2, 3, 4, 5, 6, 8],
+    "sensing_radius": [2, 3, 4, 5, 6],
+    "wave_period": [0, 0, 8, 10, 12, 16, 20],
+    "wave_offset": [0, 1, 2],
+}
+
+def sample_policies(count, seed=0):
+    """
+        Returns the default policy followed by count distinct random policies.
+    """
+    rng = random.Random(seed)
+    policies = [default_light_policy()]
+    seen = {tuple(sorted(policies[0].items()))}
+    attempts = 0
+    while len(policies) < count + 1 and attempts < count * 100:
+        attempts += 1
+        policy = {key: rng.choice(values) for key, values in SEARCH_SPACE.items()}
+        if not policy["wave_period"]:
+            policy["wave_offset"] = 0  # The offset means nothing without a wave
+        key = tuple(sorted(policy.items()))
+        if key not in seen:
+            seen.add(key)
+            policies.append(policy)
+    return policies
+
+def evaluate(city_file, policy, seed, steps, stats_dir=None):
+    """
+        Runs the model headless with the policy and returns the completed
+        trips per step. The replan queue only uses its expansion budget, so the
+        run depends on the seed and the policy alone. If given, the step and
+        trip tables of the run are written to stats_dir.
+    """
+    collector = TripCollector(output_dir=stats_dir) if stats_dir else None
+    model = CityModel(endpoint=None, periodicity=steps + 1, city_file=city_file, seed=seed,
+                      replan_time_budget=None, light_policy=policy, collector=collector)
+    headless.run(model, steps)
+    model.collector.flush()
+    return model.complete_trips / steps
+
+def run_stats_dir(stats_dir, city_file, index, seed):
+    if not stats_dir:
+        return None
+    return os.path.join(stats_dir, city_name(city_file), f"policy-{index:03d}-seed-{seed}")
+
+def optimize(city_file, policies, seeds, steps, executor, stats_dir=None):
+    """
+        Evaluates every policy on every seed. Returns (mean score, policy)
+        tuples sorted from best to worst.
+    """
+    futures = [[executor.submit(evaluate, city_file, policy, seed, steps, run_stats_dir(stats_dir, city_file, index, seed))
+                for seed in seeds]
+               for index, policy in enumerate(policies)]
+    results = [(sum(future.result() for future in runs) / len(runs), policy)
+               for runs, policy in zip(futures, policies)]
+    return sorted(results, key=lambda result: result[0], reverse=True)
+
+def city_name(city_file):
+    return os.path.splitext(os.path.basename(city_file))[0]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Traffic light policy optimizer.')
+    parser.add_argument('-c', '--city', nargs='+', default=sorted(glob.glob('./city_files/*_base.txt')),
+                        help='City files to optimize. Default is every city_files/*_base.txt.')
+    parser.add_argument('-n', '--candidates', type=int, default=40,
+                        help='Random policies evaluated besides the default one. Default is 40.')
+    parser.add_argument('-s', '--steps', type=int, default=1000,
+                        help='Steps of each run. Default is 1000.')
+    parser.add_argument('-r', '--seeds', type=int, default=4,
+                        help='Seeds (runs) per candidate. Default is 4.')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='Worker processes. Default is the number of CPUs.')
+    parser.add_argument('-o', '--output', type=str, default='./city_files/policies',
+                        help='Directory of the policy files. Default is city_files/policies.')
+    parser.add_argument('--stats-dir', type=str, default=None,
+                        help='Directory where the per-step and per-trip tables of every run are written as Parquet.')
+    args = parser.parse_args()
+
+    policies = sample_policies(args.candidates)
+    seeds = list(range(args.seeds))
+    os.makedirs(args.output, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=args.processes) as executor:
+        for city_file in args.city:
+            results = optimize(city_file, policies, seeds, args.steps, executor, args.stats_dir)
+            baseline = next(score for score, policy in results if policy == policies[0])
+
+            print(f"{city_file}: {len(policies)} policies, {len(seeds)} seeds, {args.steps} steps")
+            for score, policy in results[:5]:
+                print(f"    {score:.4f} trips/step  {policy}")
+            print(f"    {baseline:.4f} trips/step  default policy")
+
+            score, policy = results[0]
+            path = os.path.join(args.output, f"{city_name(city_file)}.json")
+            with open(path, 'w') as policyFile:
+                json.dump(dict(policy, trips_per_step=score, baseline_trips_per_step=baseline,
+                               steps=args.steps, seeds=len(seeds)), policyFile, indent=4)
+            print(f"    Saved to {path}")
@@ -0,0 +1,160 @@
+"""
+    Layered rendering of the city grid. The static layer (roads, obstacles and
+    destinations) never changes during a run, so it is collected once per model
+    and only the cars and the light states are drawn on every frame, from the
+    schedule and the light list instead of a scan of every cell.
+
+    The same layers are used by the 2d Mesa view (canvas.py) and by the
+    headless frame export of this script, which rasterizes each frame with
+    Pillow and writes PNG frames or an animated GIF without a browser.
+
+    Arguments:
+        -s, --steps: Steps to run. Default is 300.
+        -o, --output: A .gif file, or a directory for numbered PNG frames. Default is frames.gif.
+        -e, --every: Steps between exported frames. Default is 1.
+        -z, --cell-size: Pixels per grid cell. Default is 8.
+        -d, --duration: Milliseconds each GIF frame is shown. Default is 100.
+        -c, --city: City file to run. Default is ./city_files/2023_base.txt.
+        --seed: Random seed of the model. Default is 0.
+        --stats-dir: Directory where the per-step and per-trip tables are written as Parquet.
+"""
+import argparse
+import os
+from agent import Car, Destination, Obstacle, Road
+
+# Cell codes of the raster and their colors, the same as the 2d Mesa view
+EMPTY, ROAD, OBSTACLE, DESTINATION, RED_LIGHT, GREEN_LIGHT, CAR = range(7)
+PALETTE = (
+    (255, 255, 255),  # Empty
+    (128, 128, 128),  # Road, grey
+    (95, 158, 160),   # Obstacle, cadetblue
+    (144, 238, 144),  # Destination, lightgreen
+    (255, 0, 0),      # Red light
+    (0, 128, 0),      # Green light
+    (0, 0, 255),      # Car, blue
+)
+
+def static_agents(model):
+    """
+        Returns the agents that never move or change color: the shared roads
+        and obstacles, the roads under the traffic lights and the destinations.
+    """
+    agents = list(model.static_agents)
+    for light in model.traffic_lights:
+        agents.extend(agent for agent in model.grid.get_cell_list_contents([light.pos]) if isinstance(agent, Road))
+    agents.extend(agent for agent in model.schedule.agents if isinstance(agent, Destination))
+    return agents
+
+def dynamic_agents(model):
+    """
+        Returns the traffic lights and the cars, the agents drawn on every frame.
+    """
+    return model.traffic_lights + [agent for agent in model.schedule.agents if isinstance(agent, Car)]
+
+class FrameRenderer:
+    """
+    Rasterizes frames of a model. The static layer is a byte per cell built
+    once; a frame copies it, sets the cells of the lights and cars and scales
+    it to an image.
+
+    Attributes:
+        model: The model being rendered.
+        cell_size: Pixels per grid cell.
+        static: Cell codes of the static layer, row by row from the top.
+    """
+    def __init__(self, model, cell_size=8):
+        self.model = model
+        self.cell_size = cell_size
+        self.width = model.grid.width
+        self.height = model.grid.height
+        self.static = bytearray(self.width * self.height)
+        for agent in static_agents(model):
+            if isinstance(agent, Obstacle):
+                code = OBSTACLE
+            elif isinstance(agent, Destination):
+                code = DESTINATION
+            else:
+                code = ROAD
+            index = self.index(agent.pos)
+            # A destination is drawn over the road it is on
+            self.static[index] = max(self.static[index], code)
+
+    def index(self, pos):
+        x, y = pos
+        return (self.height - 1 - y) * self.width + x  # Row 0 is the top of the map
+
+    def cells(self):
+        """
+            Returns the cell codes of the current state of the model.
+        """
+        cells = bytearray(self.static)
+        for light in self.model.traffic_lights:
+            cells[self.index(light.pos)] = GREEN_LIGHT if light.state else RED_LIGHT
+        for agent in self.model.schedule.agents:
+            if isinstance(agent, Car):
+                cells[self.index(agent.pos)] = CAR
+        return cells
+
+    def frame(self):
+        """
+            Returns the current state of the model as a palette image.
+            Pillow is only needed for frame export.
+        """
+        from PIL import Image
+        image = Image.frombytes("P", (self.width, self.height), bytes(self.cells()))
+        image.putpalette([channel for color in PALETTE for channel in color])
+        return image.resize((self.width * self.cell_size, self.height * self.cell_size), Image.NEAREST)
+
+def export(model, steps, output, every=1, cell_size=8, duration=100):
+    """
+        Runs the model headless and exports a frame before the first step and
+        every given number of steps. Writes an animated GIF if the output ends
+        in .gif, numbered PNG frames in the output directory otherwise.
+        Returns the number of frames written.
+    """
+    import headless
+    renderer = FrameRenderer(model, cell_size)
+    frames = [renderer.frame()]
+
+    def capture(model):
+        if model.schedule.steps % every == 0:
+            frames.append(renderer.frame())
+
+    headless.run(model, steps, on_step=capture)
+
+    if output.lower().endswith(".gif"):
+        frames[0].save(output, save_all=True, append_images=frames[1:], duration=duration, loop=0)
+    else:
+        os.makedirs(output, exist_ok=True)
+        for number, frame in enumerate(frames):
+            frame.save(os.path.join(output, f"frame_{number:06d}.png"))
+    return len(frames)
+
+if __name__ == '__main__':
+    from model import CityModel
+    from collector import TripCollector
+
+    parser = argparse.ArgumentParser(description='Headless frame export of the traffic model.')
+    parser.add_argument('-s', '--steps', type=int, default=300,
+                        help='Steps to run. Default is 300.')
+    parser.add_argument('-o', '--output', type=str, default='frames.gif',
+                        help='A .gif file, or a directory for numbered PNG frames. Default is frames.gif.')
+    parser.add_argument('-e', '--every', type=int, default=1,
+                        help='Steps between exported frames. Default is 1.')
+    parser.add_argument('-z', '--cell-size', type=int, default=8,
+                        help='Pixels per grid cell. Default is 8.')
+    parser.add_argument('-d', '--duration', type=int, default=100,
+                        help='Milliseconds each GIF frame is shown. Default is 100.')
+    parser.add_argument('-c', '--city', type=str, default='./city_files/2023_base.txt',
+                        help='City file to run. Default is ./city_files/2023_base.txt.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed of the model. Default is 0.')
+    parser.add_argument('--stats-dir', type=str, default=None,
+                        help='Directory where the per-step and per-trip tables are written as Parquet.')
+    args = parser.parse_args()
+
+    collector = TripCollector(output_dir=args.stats_dir) if args.stats_dir else None
+    model = CityModel(endpoint=None, periodicity=60, city_file=args.city, seed=args.seed, collector=collector)
+    count = export(model, args.steps, args.output, args.every, args.cell_size, args.duration)
+    model.collector.flush()
+    print(f"Exported {count} frames to {args.output}")
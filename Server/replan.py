@@ -0,0 +1,124 @@
+"""
+    This file contains the replan queue for the city simulation. Cars that are
+    stuck or that arrive at the wrong destination ask the queue for a new path
+    instead of running A* in the middle of their step, and the model serves the
+    queue once per step within a time and node expansion budget. New cars use the
+    queue too, so a spawn wave does not run four searches in the same step.
+"""
+import time
+from agent import reverse_search
+
+class ReplanQueue:
+    """
+    Model-level queue of pending path recalculations. Requests are served by
+    priority (cars that have waited the longest first) until the per-step budget
+    is spent, the rest stay queued for the following steps. Cars that share a
+    destination and blocked cells are batched: a single search backwards from
+    the destination finds the paths of every car of the batch.
+
+    Attributes:
+        model: The model instance the queue belongs to.
+        time_budget: Maximum seconds spent searching paths in a single step, None
+            to only use the expansion budget (reproducible runs).
+        expansion_budget: Maximum A* node expansions in a single step.
+        pending: Dictionary mapping each waiting car to its blocked cells and
+            the step its request was made.
+    """
+    def __init__(self, model, time_budget=0.01, expansion_budget=1500):
+        self.model = model
+        self.time_budget = time_budget
+        self.expansion_budget = expansion_budget
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def request(self, car, block_cells=None):
+        """
+            Queues a replan for the car. A car only holds one request at a
+            time, the first one is kept until it is served.
+        """
+        if car not in self.pending:
+            self.pending[car] = (tuple(block_cells or ()), self.model.schedule.steps)
+            self.model.metrics.replans_requested.inc()
+
+    def cancel(self, car):
+        """
+            Drops the request of a car that left the map.
+        """
+        self.pending.pop(car, None)
+
+    def priority(self, item):
+        """
+            Sort key of a request: longest waiting car first, then oldest
+            request, then id so the order does not depend on insertion.
+        """
+        car, (_, requested_at) = item
+        return (-car.wait_steps, requested_at, str(car.unique_id))
+
+    def process(self):
+        """
+            Serves queued requests until the step budget is exhausted. At least
+            one search runs every step so the queue always makes progress.
+            Returns the number of cars that received a new path.
+        """
+        stats = self.model.search_stats
+        start_time = time.perf_counter()
+        start_expansions = stats["expansions"]
+        searches = 0
+        served = 0
+
+        # Group the requests by destination and blocked cells keeping the
+        # priority order, the group order follows its most urgent car. A car
+        # never goes back to its own cell on a shortest path, so blocking it
+        # (cars on a wrong destination) changes nothing and is left out of the key.
+        batches = {}
+        for car, (block_cells, _) in sorted(self.pending.items(), key=self.priority):
+            if car.pos is None:  # Removed from the grid while waiting
+                del self.pending[car]
+                continue
+            block_cells = tuple(cell for cell in block_cells if cell != car.pos)
+            batches.setdefault((car.destination, block_cells), []).append(car)
+
+        for (destination, block_cells), cars in batches.items():
+            over_budget = (stats["expansions"] - start_expansions > self.expansion_budget
+                           or (self.time_budget is not None
+                               and time.perf_counter() - start_time > self.time_budget))
+            if searches and over_budget:
+                return served
+            paths = self.batch_paths(cars, block_cells)
+            searches += 1
+            stats["shared"] += len(cars) - 1
+
+            for car in cars:
+                del self.pending[car]
+                path = paths[car]
+                if path:
+                    car.path = path
+                    car.route_count += 1
+                    # Forget the stuck history so the new path gets a chance
+                    car.position_history = []
+                    car.is_stuck = False
+                    served += 1
+                else:
+                    print(f"Agent {car.unique_id} could not find a path to {destination.get_position()}, keeping current path.")
+
+        return served
+
+    def batch_paths(self, cars, block_cells):
+        """
+            Returns a dictionary with the path of every car of a batch. A lone
+            car runs A*, larger batches share one reverse search.
+        """
+        if len(cars) == 1:
+            return {cars[0]: cars[0].search_path(list(block_cells) or None)}
+
+        model = self.model
+        destination = cars[0].destination.get_position()
+        started = time.perf_counter()
+        # Cars on the same cell share its path
+        paths = reverse_search(model.grid, destination, list(dict.fromkeys(car.pos for car in cars)),
+                               cars[0].is_path_clear, list(block_cells) or None,
+                               model.search_stats, model.search_buffers)
+        model.metrics.astar_seconds.observe(time.perf_counter() - started)
+        return {car: list(paths[car.pos]) for car in cars}
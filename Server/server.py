@@ -6,6 +6,45 @@
         -e, --endpoint: Endpoint URL for posting stats. Note: The server will not ping if no endpoint is provided even if the periodicity is set.
         -f, --frequency: Time interval (in steps) between consecutive posts. Default is 60.
         -m, --mode: Visualization mode: 2d mesa portrayal or 3d (for use with Unity). Default is 3d.    
+        -s, --server: Server for the 3d mode: dev (Flask debug server) or production
+            (waitress without debugger or reloader). Default is dev.
+        -t, --threads: Request threads of the production server. Default is 8.
+        --stats-dir: Directory where the per-step and per-trip tables are written as
+            Parquet, one run-<n> subdirectory per model. Default is memory only.
+        --host: Interface to listen on. Default is localhost.
+
+    Model initialization (3d mode):
+        POST /init: Creates a new model. The optional JSON body can choose the map with
+            {"cityFile": "<file in city_files>"} and the traffic light policy with
+            {"lightPolicy": {...}} or {"lightPolicy": "<file in city_files/policies>"},
+            as written by optimizer.py. Cars enter at the corners and at the extra
+            {"spawnPoints": [[x, z], ...]}, following {"demandProfile": {"segments":
+            [[start step, cars per step], ...], "period": n}} (see spawn.py), and are
+            admitted while the roads ahead are below {"maxOccupancy": 0.5} occupied.
+            {"activation": "simultaneous"} moves all cars at once instead of in random order.
+
+    Agent state encodings (3d mode):
+        GET /getAgents: JSON by default. With "Accept: application/x-swiftcars-packed"
+            or ?format=packed, cars and light states in the binary layout of wire.py.
+        GET /getLightIndex: Traffic lights in the order of the packed light states.
+        GET /getTrajectories?lookahead=k&since=step: Next k planned cells of the cars whose
+            plan changed after the given step (all cars without since), cars removed since
+            then, and the traffic light states with their remaining green steps. modelId
+            changes when /init or /restore replaces the model, every car is sent again then.
+
+    Checkpoints (3d mode):
+        GET /checkpoint: Compressed dynamic state of the model.
+        POST /restore: Replaces the model with the checkpoint sent as the request body.
+
+    Statistics (3d mode):
+        GET /getStats?start=a&end=b (or ?window=n): Completed trips per step, travel times,
+            red light waits and reroutes for the steps in [a, b), by default the last 100.
+            The range is clipped to the steps still held in memory, start and end give the bounds used.
+
+    Instrumentation (3d mode):
+        GET /metrics: Step phase timings, A* and replan counters in the Prometheus text format.
+        POST /profile: Profiles the next {"steps": n} calls to /update with cProfile.
+        GET /profile: Report of the last finished profile capture.
 
     Authors:
         Pablo Banzo Prida
@@ -13,29 +52,55 @@
 
     Date: 30/11/2023
 """
-from flask import Flask, request, jsonify
-from model import CityModel
+from flask import Flask, request, jsonify, Response
+from model import CityModel, DEFAULT_CITY_FILE, city_path, load_city, load_light_policy
+from session import ModelSession
+from metrics import MetricsRegistry, ProfileCapture, PhaseTimer
+from wire import PACKED_MIMETYPE
 from agent import Car, Traffic_Light, Obstacle, Road, Destination
 import argparse
-from mesa.visualization import CanvasGrid, ModularServer
+import atexit
+import os
+import zlib
 
 # Model configuration
 width = 0
 height = 0
-cityModel = None
-currentStep = 0
-periodicity = None
-endpoint = None
+session = ModelSession()
+POLICY_DIR = './city_files/policies'
 
 app = Flask("Traffic")
 
+# Server instrumentation, the model keeps its own step metrics
+serverMetrics = MetricsRegistry()
+serializeSeconds = serverMetrics.histogram("serialize_seconds", "Time spent building a response from the model.", label="route")
+profileCapture = ProfileCapture()
+
 @app.route('/init', methods=['POST']) #
 def initModel():
-    global width, height, cityModel, currentStep
     if request.method == 'POST':
-        currentStep = 0
-
-        cityModel = CityModel(periodicity=periodicity, endpoint=endpoint)
+        body = request.get_json(silent=True) or {}
+        try:
+            kwargs = {}
+            if body.get("cityFile"):
+                # Only files inside city_files can be loaded
+                kwargs["city_file"] = city_path(body["cityFile"])
+            light_policy = body.get("lightPolicy")
+            if isinstance(light_policy, str):
+                light_policy = load_light_policy(os.path.join(POLICY_DIR, os.path.basename(light_policy)))
+            if light_policy is not None:
+                kwargs["light_policy"] = light_policy
+            if body.get("spawnPoints"):
+                kwargs["spawn_points"] = [(int(x), int(z)) for x, z in body["spawnPoints"]]
+            if body.get("demandProfile"):
+                kwargs["demand_profile"] = body["demandProfile"]
+            if body.get("activation"):
+                kwargs["activation"] = body["activation"]
+            if body.get("maxOccupancy") is not None:
+                kwargs["max_occupancy"] = float(body["maxOccupancy"])
+            session.init(**kwargs)
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            return jsonify({"message": f"Invalid parameters: {e}"}), 400
         return jsonify({"message": "Parameters received, model initiated."})
     else:
         return jsonify({
@@ -44,8 +109,7 @@ def initModel():
     
 @app.route('/getAgents', methods=['GET'])
 def getAgents():
-    global cityModel
-    if not cityModel:
+    if not session.is_initialized():
         return jsonify({
             "message": "Model not initialized."
         }), 500
@@ -54,66 +118,126 @@ def getAgents():
     # static = request.args.get('static', 'false').lower() == 'true'
 
     if request.method == 'GET':
-        obstaclePositions = [{"id": str(obstacle.unique_id), "x": x, "y": 0, "z": z}
-                    for x in range(cityModel.grid.width)
-                    for z in range(cityModel.grid.height)
-                    for obstacle in cityModel.grid.get_cell_list_contents((x, z))
-                    if isinstance(obstacle, Obstacle)]
-        trafficLightPositions = [{"id": str(a.unique_id), "x": x, "y": 0, "z": z, "state": "red" if not a.state else "green", "axis": a.axis, "direction": a.direction}
-                            for x in range(cityModel.grid.width)
-                            for z in range(cityModel.grid.height)
-                            for a in cityModel.grid.get_cell_list_contents((x, z))
-                            if isinstance(a, Traffic_Light)]
-        roadPositions = [{"id": str(road.unique_id), "x": x, "y": 0, "z": z}
-                    for x in range(cityModel.grid.width)
-                    for z in range(cityModel.grid.height)
-                    for road in cityModel.grid.get_cell_list_contents((x, z))
-                    if isinstance(road, Road)]
-        destinationPositions = [{"id": str(destination.unique_id), "x": x, "y": 0, "z": z}
-                    for x in range(cityModel.grid.width)
-                    for z in range(cityModel.grid.height)
-                    for destination in cityModel.grid.get_cell_list_contents((x, z))
-                    if isinstance(destination, Destination)]
-        carPositions = [{"id": str(car.unique_id), "x": x, "y": 0, "z": z}
-                        for x in range(cityModel.grid.width)
-                        for z in range(cityModel.grid.height)
-                        for car in cityModel.grid.get_cell_list_contents((x, z))
-                        if isinstance(car, Car)]
-        
-        return jsonify(
-            {'carPos':carPositions,
-                'obstaclePos':obstaclePositions, 
-                'trafficLightPos':trafficLightPositions, 
-                'roadPos':roadPositions, 
-                'destinationPos':destinationPositions
-                })
+        # Clients that ask for the packed encoding get cars and light states
+        # only, the static layout is sent in JSON once
+        packed = (request.args.get('format') == 'packed'
+                  or request.accept_mimetypes.best == PACKED_MIMETYPE)
+
+        # Every reader of the same step shares one snapshot and its bodies
+        with PhaseTimer(serializeSeconds, 'getAgents'):
+            snapshot = session.get_snapshot()
+            body = snapshot.to_packed() if packed else snapshot.to_json()
+        response = Response(body, mimetype=PACKED_MIMETYPE if packed else 'application/json')
+        # The encoding depends on the Accept header, caches must keep them apart
+        response.vary.add('Accept')
+        return response
+
+@app.route('/getLightIndex', methods=['GET'])
+def getLightIndex():
+    # Order of the traffic light states in the packed encoding
+    if not session.is_initialized():
+        return jsonify({
+            "message": "Model not initialized."
+        }), 500
+    return jsonify({'trafficLights': session.get_snapshot().light_index()})
+
+@app.route('/getTrajectories', methods=['GET'])
+def getTrajectories():
+    if not session.is_initialized():
+        return jsonify({
+            "message": "Model not initialized."
+        }), 500
+
+    since = request.args.get('since', type=int)
+    lookahead = request.args.get('lookahead', type=int)
+    if lookahead is not None and lookahead <= 0:
+        return jsonify({"message": "Lookahead should be a positive integer."}), 400
+
+    with PhaseTimer(serializeSeconds, 'getTrajectories'):
+        response = jsonify(session.get_trajectories(since, lookahead))
+    return response
 
 @app.route('/update', methods=['GET'])
 def updateModel():
     # desde unity se va a mandar un get para que se actualice el modelo
     # una vez que se actualice, se regresa un mensaje de que se actualizó y el
     # paso en el que va
-    global currentStep, cityModel
-    if not cityModel:
+    if not session.is_initialized():
         return jsonify({
             "message": "Model not initialized."
         }), 500
     if request.method == 'GET':
-        cityModel.step()
-        currentStep += 1
+        currentStep = session.step(runner=profileCapture.run)
         print(f"Step {currentStep}")
         return jsonify({'message':f'Model updated to step {currentStep}.', 'currentStep':currentStep})
 
 @app.route('/setCycle', methods=['POST'])
 def updateCycle():
-    global cityModel
-    if not cityModel:
+    if not session.is_initialized():
         return jsonify({
             "message": "Model not initialized."
         }), 500
     if request.method == 'POST':
-        cityModel.set_cycle(request.json['cycle'])
-        return jsonify({'message':f'Cycle updated to {cityModel.cycle}.'})
+        cycle = session.set_cycle(request.json['cycle'])
+        return jsonify({'message':f'Cycle updated to {cycle}.'})
+
+@app.route('/checkpoint', methods=['GET'])
+def getCheckpoint():
+    # Dynamic state of the model (see checkpoint.py), can be sent back to /restore
+    if not session.is_initialized():
+        return jsonify({
+            "message": "Model not initialized."
+        }), 500
+    return Response(session.checkpoint(), mimetype='application/octet-stream')
+
+@app.route('/restore', methods=['POST'])
+def restoreModel():
+    try:
+        currentStep = session.restore(request.get_data())
+    except (OSError, ValueError, KeyError, TypeError, zlib.error) as e:
+        return jsonify({"message": f"Invalid checkpoint: {e}"}), 400
+    return jsonify({'message':f'Model restored at step {currentStep}.', 'currentStep':currentStep})
+
+@app.route('/getStats', methods=['GET'])
+def getStats():
+    # Throughput, travel times and red light waits over a window of steps
+    if not session.is_initialized():
+        return jsonify({
+            "message": "Model not initialized."
+        }), 500
+    window = request.args.get('window', 100, type=int)
+    if window <= 0:
+        return jsonify({"message": "Window should be a positive integer."}), 400
+    return jsonify(session.query_stats(request.args.get('start', type=int),
+                                       request.args.get('end', type=int), window))
+
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    # Prometheus text exposition of the server and model metrics
+    text = serverMetrics.render() + session.render_metrics()
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+@app.route('/profile', methods=['GET', 'POST'])
+def profileSteps():
+    if request.method == 'POST':
+        try:
+            steps = (request.get_json(silent=True) or {}).get('steps', 10)
+            if isinstance(steps, bool):
+                raise TypeError("steps should be a number")
+            steps = int(steps)
+        except (ValueError, TypeError, AttributeError) as e:
+            return jsonify({"message": f"Invalid parameters: {e}"}), 400
+        if steps <= 0:
+            return jsonify({"message": "Steps should be a positive integer."}), 400
+        with session.lock:
+            profileCapture.arm(steps)
+        return jsonify({'message':f'Profiling the next {steps} steps.'})
+
+    if profileCapture.report_text is None:
+        return jsonify({
+            "message": "No profile captured yet." if not profileCapture.is_armed() else "Profile capture in progress."
+        }), 404
+    return Response(profileCapture.report_text, mimetype='text/plain')
 
 
 # 2D visualization
@@ -156,17 +280,25 @@ def agent_portrayal(agent):
 
     return portrayal
 
-# Global variables for model dimensions
-width = 0
-height = 0
+def launch_2d(endpoint, periodicity, port):
+    """
+        Launches the Mesa visualization server. The map is only read and the
+        canvas only built in 2d mode. Mesa 2.1.4 itself imports its
+        visualization (and Tornado) from mesa/__init__.py, so every mode
+        still loads it through `from mesa import ...`.
+    """
+    from mesa.visualization import ModularServer
+    from canvas import LayeredCanvasGrid
 
-# Read city file and determine dimensions
-with open('city_files/2023_base.txt') as baseFile:
-    lines = baseFile.readlines()
+    # Grid dimensions from the (cached) city file
+    _, lines = load_city(DEFAULT_CITY_FILE)
     width = len(lines[0]) - 1
     height = len(lines)
 
-grid = CanvasGrid(agent_portrayal, width, height, 500, 500)
+    grid = LayeredCanvasGrid(agent_portrayal, width, height, 500, 500)
+    mesa_server = ModularServer(CityModel, [grid], "Traffic Base", {"endpoint": endpoint, "periodicity": periodicity})
+    mesa_server.port = port
+    mesa_server.launch()
 
 # Argument validation functions
 def validate_port(port):
@@ -190,6 +322,8 @@ if __name__ == '__main__':
     server_group = parser.add_argument_group('server configuration')
     server_group.add_argument('-p', '--port', type=int, default=8585,
                             help='Port number for the server to listen on. Default is 8585.')
+    server_group.add_argument('--host', type=str, default='localhost',
+                            help='Interface to listen on. Default is localhost.')
 
     # Stats posting configuration
     post_group = parser.add_argument_group('stats posting configuration')
@@ -198,27 +332,46 @@ if __name__ == '__main__':
                             help='Endpoint URL for posting stats. Note: The server will not ping if no endpoint is provided even if the periodicity is set.')
     post_group.add_argument('-f', '--frequency', type=int, default=60,
                             help='Time interval (in steps) between consecutive posts. Default is 60.')
+    post_group.add_argument('--stats-dir', type=str, default=None,
+                            help='Directory where the per-step and per-trip tables are written as Parquet, one run-<n> subdirectory per model. Default is memory only.')
 
     # Mode configuration
     mode_group = parser.add_argument_group('mode configuration')
     mode_group.add_argument('-m', '--mode', choices=['2d', '3d'], default='3d',
                             help='Visualization mode: 2d mesa portrayal or 3d (for use with Unity). Default is 3d.')
+    mode_group.add_argument('-s', '--server', choices=['dev', 'production'], default='dev',
+                            help='Server for the 3d mode: dev (Flask debug server) or production (waitress without debugger or reloader). Default is dev.')
+    mode_group.add_argument('-t', '--threads', type=int, default=8,
+                            help='Request threads of the production server. Default is 8.')
 
     # Parse the arguments
     args = parser.parse_args()
 
     # Launch the appropriate server based on the mode
     if args.mode == '2d':
-        mesa_server = ModularServer(CityModel, [grid], "Traffic Base", {"endpoint": args.endpoint, "periodicity": args.frequency})
-        mesa_server.port = args.port
-        mesa_server.launch()
+        launch_2d(args.endpoint, args.frequency, args.port)
     else:
         # Validate the post periodicity
-        periodicity = args.frequency
-        endpoint = args.endpoint
-
-        app.run(
-            host='localhost',
-            port=args.port,
-            debug=True
-        )
\ No newline at end of file
+        session.periodicity = args.frequency
+        session.endpoint = args.endpoint
+        session.stats_dir = args.stats_dir
+        # Write the last partial chunk of the tables when the server stops
+        atexit.register(session.close)
+
+        if args.server == 'production':
+            # The model lives in this process, so requests are spread over
+            # threads of a single worker and synchronized by the session
+            from waitress import serve
+
+            serve(
+                app,
+                host=args.host,
+                port=args.port,
+                threads=args.threads
+            )
+        else:
+            app.run(
+                host=args.host,
+                port=args.port,
+                debug=True
+            )
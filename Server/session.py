@@ -0,0 +1,254 @@
+"""
+    This file contains the session that owns the city model for the server.
+    Every change to the model (init, step, cycle) happens under a lock, and
+    readers get an immutable snapshot of the agents built once per step, so a
+    viewer never sees a model halfway through a step and concurrent reads do not
+    wait for each other.
+"""
+import json
+import os
+import threading
+from model import CityModel
+from collector import TripCollector
+from wire import encode_agents
+from trajectory import TrajectoryTracker
+import checkpoint
+from agent import Car, Obstacle, Road, Destination
+
+class Snapshot:
+    """
+    Read-only view of the model at a given step. The JSON and packed bodies are
+    rendered the first time they are requested and shared by every reader of
+    the same step.
+
+    Attributes:
+        step: Step of the model when the snapshot was taken.
+        cars: List of (id, x, z) tuples of the cars.
+        lights: List of (light, state, direction) tuples of the traffic lights.
+        layout: Static agents of the map, shared by every snapshot of a model.
+    """
+    def __init__(self, step, cars, lights, layout):
+        self.step = step
+        self.cars = cars
+        self.lights = lights
+        self.layout = layout
+        self._json = None
+        self._packed = None
+
+    def to_dict(self):
+        return {
+            'carPos': [{"id": car_id, "x": x, "y": 0, "z": z} for car_id, x, z in self.cars],
+            'obstaclePos': self.layout['obstaclePos'],
+            'trafficLightPos': [{"id": str(light.unique_id), "x": light.pos[0], "y": 0, "z": light.pos[1],
+                                 "state": "red" if not state else "green", "axis": light.axis, "direction": direction}
+                                for light, state, direction in self.lights],
+            'roadPos': self.layout['roadPos'],
+            'destinationPos': self.layout['destinationPos'],
+        }
+
+    def to_json(self):
+        if self._json is None:
+            self._json = json.dumps(self.to_dict(), separators=(',', ':'))
+        return self._json
+
+    def to_packed(self):
+        if self._packed is None:
+            self._packed = encode_agents(self.step, self.cars, [state for _, state, _ in self.lights])
+        return self._packed
+
+    def light_index(self):
+        """
+            Returns the traffic lights in the order of the packed light states.
+        """
+        return [{"index": index, "id": str(light.unique_id), "x": light.pos[0], "y": 0, "z": light.pos[1],
+                 "axis": light.axis, "direction": direction}
+                for index, (light, _, direction) in enumerate(self.lights)]
+
+def build_layout(model):
+    """
+        Collects the static agents of the map (obstacles, roads and
+        destinations) in a single pass over the grid.
+    """
+    layout = {'obstaclePos': [], 'roadPos': [], 'destinationPos': []}
+    keys = {Obstacle: 'obstaclePos', Road: 'roadPos', Destination: 'destinationPos'}
+    for x in range(model.grid.width):
+        for z in range(model.grid.height):
+            for agent in model.grid.get_cell_list_contents((x, z)):
+                key = keys.get(type(agent))
+                if key:
+                    layout[key].append({"id": str(agent.unique_id), "x": x, "y": 0, "z": z})
+    return layout
+
+class ModelSession:
+    """
+    Owns the city model served to the clients.
+
+    Attributes:
+        lock: Re-entrant lock held while the model is created, stepped or changed.
+        model: The current CityModel, None until init() is called.
+        current_step: Number of steps run since the last init().
+        model_id: Number of the current model, changes every time the model is replaced.
+        endpoint, periodicity: Stats posting configuration passed to the model.
+        stats_dir: Directory where the step and trip tables of every model are
+            written as Parquet (one run-<n> subdirectory per model), None to
+            only keep them in memory.
+    """
+    def __init__(self, endpoint=None, periodicity=60):
+        self.lock = threading.RLock()
+        self.model = None
+        self.current_step = 0
+        self.endpoint = endpoint
+        self.periodicity = periodicity
+        self.layout = None
+        self.snapshot = None
+        self.trajectories = None  # Started by the first trajectory request
+        self.stats_dir = None
+        self.runs = 0  # Models created, numbers the stats directories
+        self.model_id = 0
+
+    def is_initialized(self):
+        return self.model is not None
+
+    def new_collector(self):
+        """
+            Returns the collector of a new model, None for the default one.
+        """
+        if not self.stats_dir:
+            return None
+        self.runs += 1
+        return TripCollector(output_dir=os.path.join(self.stats_dir, f"run-{self.runs:04d}"))
+
+    def replace(self, model):
+        """
+            Writes the pending rows of the current model, if any, and makes the
+            given model the current one. Must be called with the lock held.
+        """
+        if self.model is not None:
+            self.model.collector.flush()
+        self.model = model
+        self.model_id += 1
+
+    def close(self):
+        """
+            Writes the pending rows of the current model (e.g. on shutdown).
+        """
+        with self.lock:
+            if self.model is not None:
+                self.model.collector.flush()
+
+    def init(self, **kwargs):
+        """
+            Creates a new model, replacing the current one.
+        """
+        with self.lock:
+            collector = self.new_collector()
+        model = CityModel(endpoint=self.endpoint, periodicity=self.periodicity, collector=collector, **kwargs)
+        with self.lock:
+            self.replace(model)
+            self.current_step = 0
+            self.layout = None
+            self.snapshot = None
+            self.trajectories = None
+
+    def step(self, runner=None):
+        """
+            Advances the model one step. If given, runner is called with the
+            model step function (e.g. a profiler). Returns the new step number.
+        """
+        with self.lock:
+            if runner:
+                runner(self.model.step)
+            else:
+                self.model.step()
+            self.current_step += 1
+            if self.trajectories:
+                self.trajectories.update(self.model, self.current_step)
+            return self.current_step
+
+    def checkpoint(self):
+        """
+            Returns the serialized dynamic state of the model.
+        """
+        with self.lock:
+            return checkpoint.dumps(self.model)
+
+    def restore(self, data):
+        """
+            Replaces the model with one restored from a checkpoint.
+        """
+        with self.lock:
+            collector = self.new_collector()
+        model = checkpoint.loads(data, endpoint=self.endpoint, periodicity=self.periodicity, collector=collector)
+        with self.lock:
+            self.replace(model)
+            self.current_step = model.schedule.steps
+            self.layout = None
+            self.snapshot = None
+            self.trajectories = None
+        return self.current_step
+
+    def set_cycle(self, cycle):
+        with self.lock:
+            self.model.set_cycle(cycle)
+            return self.model.cycle
+
+    def get_snapshot(self):
+        """
+            Returns the snapshot of the current step, building it if this is
+            the first read since the last step.
+        """
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.step == self.current_step:
+            return snapshot
+
+        with self.lock:
+            if self.snapshot is None or self.snapshot.step != self.current_step:
+                self.snapshot = self.take_snapshot()
+            return self.snapshot
+
+    def take_snapshot(self):
+        """
+            Copies the dynamic state of the model. Must be called with the lock held.
+        """
+        model = self.model
+        if self.layout is None:
+            self.layout = build_layout(model)
+
+        cars = sorted((car.pos[0], car.pos[1], str(car.unique_id))
+                      for car in model.schedule.agents if isinstance(car, Car))
+        lights = sorted(model.traffic_lights, key=lambda light: light.pos)
+        return Snapshot(self.current_step,
+                        [(car_id, x, z) for x, z, car_id in cars],
+                        [(light, light.state, light.direction) for light in lights],
+                        self.layout)
+
+    def get_trajectories(self, since=None, lookahead=None):
+        """
+            Returns the planned cells of the cars announced after the given
+            step, see TrajectoryTracker.changes, and the id of the model they
+            belong to.
+        """
+        with self.lock:
+            if self.trajectories is None:
+                self.trajectories = TrajectoryTracker(self.current_step)
+                self.trajectories.update(self.model, self.current_step)
+            changes = self.trajectories.changes(self.model, self.current_step, since, lookahead)
+            changes["modelId"] = self.model_id
+            return changes
+
+    def query_stats(self, start=None, end=None, window=100):
+        """
+            Summarizes the trips and steps in [start, end), by default the last
+            window steps.
+        """
+        with self.lock:
+            end = self.model.schedule.steps if end is None else end
+            start = max(end - window, 0) if start is None else start
+            return self.model.collector.query(start, end)
+
+    def render_metrics(self):
+        """
+            Renders the model metrics without racing a step.
+        """
+        with self.lock:
+            return self.model.metrics.render() if self.model else ""
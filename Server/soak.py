@@ -0,0 +1,118 @@
+"""
+    Long-run memory soak test for the city model. Runs the model headless for
+    a large number of steps while tracemalloc traces every allocation, reports
+    the memory allocated per step and the retained memory of each subsystem, and
+    fails if the retained memory keeps growing past a threshold.
+
+    The model gets a small trip collector whose ring of chunks fills up during
+    the warmup, so the collector is still measured but its bounded history does
+    not count as growth.
+
+    Arguments:
+        -s, --steps: Number of steps to run. Default is 1000000.
+        -w, --warmup: Steps run before the baseline is taken. Default is 2000.
+        -i, --interval: Steps between memory samples. Default is 10000.
+        -t, --threshold: Maximum retained growth after the warmup, in KiB. Default is 512.
+
+    Example:
+        python soak.py --steps 200000 --interval 5000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from model import CityModel
+from collector import TripCollector
+import headless
+
+# Source files of each subsystem, everything else is reported as "other"
+SUBSYSTEMS = {
+    "agent.py": "agents/A*",
+    "replan.py": "replan queue",
+    "model.py": "model",
+    "metrics.py": "metrics",
+    "collector.py": "collector",
+}
+
+def subsystem_of(filename):
+    """
+        Maps the file of an allocation to the subsystem it belongs to.
+    """
+    name = os.path.basename(filename)
+    if name in SUBSYSTEMS:
+        return SUBSYSTEMS[name]
+    if f"{os.sep}mesa{os.sep}" in filename:
+        return "mesa"
+    return "other"
+
+def retained_by_subsystem(snapshot):
+    """
+        Returns a dictionary with the bytes currently held by each subsystem.
+    """
+    retained = {}
+    for stat in snapshot.statistics("filename"):
+        subsystem = subsystem_of(stat.traceback[0].filename)
+        retained[subsystem] = retained.get(subsystem, 0) + stat.size
+    return retained
+
+def soak(model, steps, warmup, interval, threshold):
+    """
+        Runs the soak test on the model. Returns True if the retained memory
+        grew less than threshold bytes between the end of the warmup and the
+        last sample.
+    """
+    tracemalloc.start()
+    baseline = None
+    per_step = [0, 0, 0]  # Steps, sum and maximum of bytes allocated per step since the last sample
+    started = time.perf_counter()
+
+    for step in range(1, steps + 1):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        with headless.quiet():
+            model.step()
+        allocated = tracemalloc.get_traced_memory()[1] - current
+        per_step[0] += 1
+        per_step[1] += allocated
+        per_step[2] = max(per_step[2], allocated)
+
+        if step == warmup or (step > warmup and step % interval == 0) or step == steps:
+            retained = retained_by_subsystem(tracemalloc.take_snapshot())
+            if baseline is None:
+                baseline = retained
+            total = sum(retained.values())
+            growth = total - sum(baseline.values())
+            print(f"Step {step}: {total / 1024:.1f} KiB retained ({growth / 1024:+.1f} KiB since warmup), "
+                  f"{per_step[1] / per_step[0] / 1024:.1f} KiB/step allocated on average, "
+                  f"{per_step[2] / 1024:.1f} KiB max, {step / (time.perf_counter() - started):.0f} steps/s")
+            for subsystem in sorted(retained):
+                delta = retained[subsystem] - baseline.get(subsystem, 0)
+                print(f"    {subsystem:<14} {retained[subsystem] / 1024:10.1f} KiB ({delta / 1024:+.1f})")
+            per_step = [0, 0, 0]
+
+    tracemalloc.stop()
+    if baseline is None:
+        print("The run ended before the warmup, no baseline to compare.")
+        return True
+
+    print(f"Retained growth after warmup: {growth / 1024:.1f} KiB (threshold {threshold / 1024:.1f} KiB)")
+    return growth <= threshold
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Traffic model memory soak test.')
+    parser.add_argument('-s', '--steps', type=int, default=1000000,
+                        help='Number of steps to run. Default is 1000000.')
+    parser.add_argument('-w', '--warmup', type=int, default=2000,
+                        help='Steps run before the baseline is taken. Default is 2000.')
+    parser.add_argument('-i', '--interval', type=int, default=10000,
+                        help='Steps between memory samples. Default is 10000.')
+    parser.add_argument('-t', '--threshold', type=int, default=512,
+                        help='Maximum retained growth after the warmup, in KiB. Default is 512.')
+    args = parser.parse_args()
+
+    model = CityModel(endpoint=None, periodicity=1, collector=TripCollector(chunk_size=64, keep_chunks=4))
+    if not soak(model, args.steps, args.warmup, args.interval, args.threshold * 1024):
+        print("FAILED: memory keeps growing.")
+        sys.exit(1)
+    print("PASSED")
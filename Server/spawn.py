@@ -0,0 +1,180 @@
+"""
+    This file contains the spawn controller of the city simulation. Cars are no
+    longer placed blindly at the corners every cycle steps: a demand profile
+    adds cars to a queue at each spawn point, and a queued car only enters the
+    map when its spawn cell is free and the roads right after it are not
+    congested. Under saturation the demand waits (or is dropped once its queue
+    is full) and the model keeps running, so the sustained throughput of a map
+    can be measured instead of the step it gridlocks.
+
+    Demand profiles are dictionaries such as
+        {"segments": [[0, 0.1], [200, 0.4], [400, 0.1]], "period": 600}
+    where each segment gives the cars per step requested at every spawn point
+    from its start step on, and the optional period repeats the profile. Without
+    a profile every spawn point requests one car every model.cycle steps.
+"""
+from collections import deque
+from agent import Car, Road, get_neighbors
+
+def normalize_profile(demand_profile):
+    """
+        Validates a demand profile and returns it with its segments sorted by
+        start step. Returns None for no profile.
+    """
+    if not demand_profile:
+        return None
+    segments = sorted((int(start), float(rate)) for start, rate in demand_profile["segments"])
+    period = int(demand_profile.get("period") or 0)
+    if not segments or segments[0][0] != 0:
+        raise ValueError("The first demand segment should start at step 0")
+    if any(rate < 0 for _, rate in segments) or period < 0:
+        raise ValueError("Demand rates and period should not be negative")
+    return {"segments": [list(segment) for segment in segments], "period": period}
+
+def is_road_cell(grid, point):
+    """
+        Checks if a cell is inside the grid and has a road, the cells where cars can enter.
+    """
+    return not grid.out_of_bounds(point) and any(isinstance(agent, Road) for agent in grid.get_cell_list_contents([point]))
+
+class SpawnController:
+    """
+    Queues the demand of every spawn point and admits cars based on the
+    occupancy of the roads downstream of it.
+
+    Attributes:
+        model: The model instance the controller belongs to.
+        points: Cells where cars enter the map.
+        demand_profile: Cars per step requested at every point (see above), or
+            None to request one car per point every model.cycle steps.
+        max_occupancy: Fraction of the downstream cells that can hold cars for
+            a new car to be admitted.
+        max_queue: Cars that can wait at a point, more demand is dropped.
+        queues: For every point, the steps at which its waiting cars were requested.
+        credits: Fractional demand accumulated at every point.
+        downstream: For every point, the road cells reachable from it in at
+            most lookahead moves.
+    """
+    def __init__(self, model, points, demand_profile=None, max_occupancy=0.5, lookahead=4, max_queue=10):
+        self.model = model
+        self.points = [tuple(point) for point in points]
+        for point in self.points:
+            if not is_road_cell(model.grid, point):
+                raise ValueError(f"Spawn point {point} is not a road cell")
+        if not 0 < max_occupancy <= 1:
+            raise ValueError(f"max_occupancy should be in (0, 1], got {max_occupancy}")
+
+        self.demand_profile = normalize_profile(demand_profile)
+        self.max_occupancy = max_occupancy
+        self.max_queue = max_queue
+        self.queues = [deque() for _ in self.points]
+        self.credits = [0.0] * len(self.points)
+        self.downstream = [self.downstream_cells(point, lookahead) for point in self.points]
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def downstream_cells(self, point, lookahead):
+        """
+            Returns the road cells a car entering at the point can reach in at
+            most lookahead moves, following the road directions.
+        """
+        grid = self.model.grid
+        seen = {point}
+        frontier = [point]
+        for _ in range(lookahead):
+            next_frontier = []
+            for cell in frontier:
+                for neighbor in get_neighbors(grid, cell):
+                    if neighbor not in seen and any(isinstance(agent, Road) for agent in grid.get_cell_list_contents([neighbor])):
+                        seen.add(neighbor)
+                        next_frontier.append(neighbor)
+            frontier = next_frontier
+        seen.discard(point)
+        return sorted(seen)
+
+    def rate(self, step):
+        """
+            Cars per step requested at every point by the demand profile.
+        """
+        period = self.demand_profile["period"]
+        if period:
+            step %= period
+        current = 0.0
+        for start, rate in self.demand_profile["segments"]:
+            if start > step:
+                break
+            current = rate
+        return current
+
+    def has_car(self, cell):
+        return any(isinstance(agent, Car) for agent in self.model.grid.get_cell_list_contents([cell]))
+
+    def occupancy(self, index):
+        """
+            Fraction of the downstream cells of a point that hold a car.
+        """
+        cells = self.downstream[index]
+        if not cells:
+            return 0.0
+        return sum(1 for cell in cells if self.has_car(cell)) / len(cells)
+
+    def add_demand(self, step):
+        """
+            Adds the cars requested in this step to the queues. Returns the
+            number of cars requested.
+        """
+        if self.demand_profile is None:
+            requested = [1 if step % self.model.cycle == 0 else 0] * len(self.points)
+        else:
+            rate = self.rate(step)
+            requested = []
+            for index in range(len(self.points)):
+                self.credits[index] += rate
+                cars = int(self.credits[index])
+                self.credits[index] -= cars
+                requested.append(cars)
+
+        metrics = self.model.metrics
+        for queue, cars in zip(self.queues, requested):
+            for _ in range(cars):
+                if len(queue) < self.max_queue:
+                    queue.append(step)
+                else:
+                    metrics.spawns_dropped.inc()
+        metrics.spawns_demanded.inc(sum(requested))
+        return sum(requested)
+
+    def admit(self):
+        """
+            Places the first waiting car of every point whose spawn cell is
+            free and whose downstream roads are below the occupancy limit.
+            Returns the number of cars placed.
+        """
+        model = self.model
+        admitted = 0
+        for index, (point, queue) in enumerate(zip(self.points, self.queues)):
+            if not queue or self.has_car(point) or self.occupancy(index) >= self.max_occupancy:
+                continue
+            destination = model.find_destination()
+            if destination is None:
+                continue
+            queue.popleft()
+            agent = Car(f"c_{model.num_agents}", model, destination)
+            model.grid.place_agent(agent, point)
+            model.schedule.add(agent)
+            model.num_agents += 1
+            admitted += 1
+        model.metrics.spawns_admitted.inc(admitted)
+        return admitted
+
+    def step(self):
+        """
+            Adds the demand of the current step and admits the cars that fit.
+            Returns the number of cars placed.
+        """
+        self.add_demand(self.model.schedule.steps)
+        admitted = self.admit()
+        for point, queue in zip(self.points, self.queues):
+            self.model.metrics.spawn_queue_length.set(len(queue), f"{point[0]},{point[1]}")
+        return admitted
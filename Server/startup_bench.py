@@ -0,0 +1,90 @@
+"""
+    Startup time benchmark. Every measurement runs in a fresh interpreter, so
+    the module caches of earlier runs do not hide the import cost that sweep
+    workers and server replicas pay when they start.
+
+    For each module it reports the time to import it, the number of modules
+    loaded and whether Mesa's visualization (mesa_viz_tornado) was pulled in,
+    and for the model the time to build the first CityModel and run its first
+    step. The time of an empty interpreter is reported as the baseline.
+
+    Arguments:
+        -r, --repeat: Fresh interpreters started per measurement. Default is 10.
+        -m, --modules: Modules whose import is timed. Default is server session model.
+        -c, --city: City file of the model. Default is ./city_files/2023_base.txt.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Code run in a fresh interpreter, prints the measured seconds as JSON
+IMPORT_CODE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+print(json.dumps({{"import": time.perf_counter() - started,
+                  "modules": len(sys.modules), "visualization": "mesa_viz_tornado" in sys.modules}}))
+"""
+
+MODEL_CODE = """
+import json, time
+import headless
+started = time.perf_counter()
+from model import CityModel
+imported = time.perf_counter()
+model = CityModel(None, 60, city_file={city!r})
+built = time.perf_counter()
+with headless.quiet():
+    model.step()
+stepped = time.perf_counter()
+print(json.dumps({{"import": imported - started, "build": built - imported, "first step": stepped - built}}))
+"""
+
+def run_fresh(code):
+    """
+        Runs the code in a new interpreter. Returns the wall time of the whole
+        process and the timings it printed.
+    """
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - started
+    timings = json.loads(result.stdout.strip().splitlines()[-1]) if result.stdout.strip() else {}
+    return dict(timings, process=wall)
+
+def measure(code, repeat):
+    """
+        Runs the code repeat times and returns the median of every timing
+        (and of the other numbers it printed).
+    """
+    runs = [run_fresh(code) for _ in range(repeat)]
+    return {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+
+def print_timings(label, timings):
+    fields = []
+    for name, value in timings.items():
+        if name == "modules":
+            fields.append(f"{value:5.0f} modules")
+        elif name == "visualization":
+            fields.append("visualization loaded" if value else "no visualization")
+        else:
+            fields.append(f"{name} {value * 1000:8.1f} ms")
+    print(f"{label:<12}" + "  ".join(fields))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Startup time benchmark.')
+    parser.add_argument('-r', '--repeat', type=int, default=10,
+                        help='Fresh interpreters started per measurement. Default is 10.')
+    parser.add_argument('-m', '--modules', nargs='+', default=['server', 'session', 'model'],
+                        help='Modules whose import is timed. Default is server session model.')
+    parser.add_argument('-c', '--city', type=str, default='./city_files/2023_base.txt',
+                        help='City file of the model. Default is ./city_files/2023_base.txt.')
+    args = parser.parse_args()
+
+    print(f"Median of {args.repeat} fresh interpreters")
+    print_timings("baseline", measure("pass", args.repeat))
+    for module in args.modules:
+        print_timings(module, measure(IMPORT_CODE.format(module=module), args.repeat))
+    print_timings("first model", measure(MODEL_CODE.format(city=args.city), args.repeat))
@@ -0,0 +1,121 @@
+"""
+    This file contains the trajectory tracker used by /getTrajectories. Each car
+    announces its next planned cells once, and a new plan is only announced when
+    the car leaves the announced cells, replans, or is about to run out of them.
+    Clients can animate several steps from one fetch and then only ask for the
+    plans that changed since the last one they have.
+"""
+from agent import Car
+
+# Largest number of planned cells a client can ask for
+MAX_HORIZON = 64
+
+class TrajectoryTracker:
+    """
+    Keeps the plan last announced for every car and the step it was announced.
+
+    Attributes:
+        horizon: Maximum number of planned cells announced per car, grows up to
+            MAX_HORIZON with the lookahead the clients ask for.
+        retention: Steps the removed cars are remembered, clients asking for
+            older changes get every plan again.
+        plans: Dictionary mapping car ids to [revision step, cells, progress],
+            where cells starts with the position of the car at the revision and
+            progress is the index of the last announced cell the car was seen on.
+        removed: List of (step, car id) of the cars that left the simulation.
+        started: Step the tracking started, changes before it are unknown.
+    """
+    def __init__(self, step, horizon=8, retention=1000):
+        self.horizon = horizon
+        self.retention = retention
+        self.plans = {}
+        self.removed = []
+        self.started = step
+
+    def announce(self, car, step):
+        self.plans[str(car.unique_id)] = [step, (car.pos,) + tuple(car.path[:self.horizon]), 0]
+
+    def follows(self, plan, car):
+        """
+            Checks if the car is still on its announced plan and updates its
+            progress. Waiting on the same cell follows the plan.
+        """
+        _, cells, progress = plan
+        try:
+            index = cells.index(car.pos, progress)
+        except ValueError:
+            return False  # Left the announced cells
+        plan[2] = index
+
+        # The rest of the announced cells must still be the start of the path
+        announced = cells[index + 1:]
+        if tuple(car.path[:len(announced)]) != announced[:len(car.path)]:
+            return False
+
+        # Extend the plan when the client is about to run out of cells
+        return len(announced) >= len(car.path) or len(announced) > self.horizon // 2
+
+    def update(self, model, step):
+        """
+            Compares the cars of the model with their announced plans after a
+            step. Must be called with the model not being stepped.
+        """
+        seen = set()
+        for car in model.schedule.agents:
+            if not isinstance(car, Car):
+                continue
+            car_id = str(car.unique_id)
+            seen.add(car_id)
+            plan = self.plans.get(car_id)
+            if plan is None or not self.follows(plan, car):
+                self.announce(car, step)
+
+        for car_id in [car_id for car_id in self.plans if car_id not in seen]:
+            del self.plans[car_id]
+            self.removed.append((step, car_id))
+
+        # Forget removals older than the retention window
+        while self.removed and self.removed[0][0] < step - self.retention:
+            self.removed.pop(0)
+
+    def is_complete_since(self, since, step):
+        """
+            Checks if the changes after the given step are all known. A step
+            after the current one comes from a client of a replaced model.
+        """
+        return since is not None and self.started <= since <= step and since >= step - self.retention
+
+    def changes(self, model, step, since=None, lookahead=None):
+        """
+            Returns the plans announced after the given step (every plan if
+            since is None, too old or ahead of the model) and the cars removed
+            since then.
+        """
+        if lookahead:
+            # Longer plans are announced from now on, current ones stay as they are
+            self.horizon = max(self.horizon, min(lookahead, MAX_HORIZON))
+        lookahead = min(lookahead or self.horizon, self.horizon)
+        full = not self.is_complete_since(since, step)
+
+        cars = []
+        for car_id, (revision, cells, _) in self.plans.items():
+            if full or revision > since:
+                cars.append({"id": car_id, "revision": revision, "x": cells[0][0], "y": 0, "z": cells[0][1],
+                             "path": [[x, z] for x, z in cells[1:lookahead + 1]]})
+
+        lights = [{"id": str(light.unique_id), "state": "green" if light.state else "red",
+                   "greenRemaining": light.green_duration if light.state else 0}
+                  for light in sorted(model.traffic_lights, key=lambda light: light.pos)]
+
+        return {
+            "currentStep": step,
+            "full": full,
+            "cars": cars,
+            "removed": [] if full else [car_id for removed_at, car_id in self.removed if removed_at > since],
+            "trafficLights": lights,
+            "lightRule": {"greenSteps": model.light_policy["green_steps"],
+                          "carThreshold": model.light_policy["car_threshold"],
+                          "sensingRadius": model.light_policy["sensing_radius"],
+                          "wavePeriod": model.light_policy["wave_period"],
+                          "waveOffset": model.light_policy["wave_offset"]},
+        }
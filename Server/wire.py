@@ -0,0 +1,78 @@
+"""
+    Compact binary encoding of the agent state sent by /getAgents. Clients ask
+    for it with the "Accept: application/x-swiftcars-packed" header (or the
+    ?format=packed parameter); JSON stays the default.
+
+    Layout (little-endian):
+        header:  4s magic "SWC1", uint32 step, uint32 car count (n), uint32 light count (m)
+        cars:    int32[n] ids, int32[n] x, int32[n] z (ids are the number of "c_<id>")
+        lights:  ceil(m / 8) bytes, bit i (least significant first) set when light i is green
+
+    Lights are indexed in the order returned by /getLightIndex, which does not
+    change for the lifetime of a model, so ids, positions and orientation are
+    only sent once.
+"""
+from array import array
+import struct
+import sys
+from agent import agent_number
+
+PACKED_MIMETYPE = 'application/x-swiftcars-packed'
+MAGIC = b'SWC1'
+HEADER = struct.Struct('<4sIII')
+
+def int32_bytes(values):
+    """
+        Packs integers as little-endian int32.
+    """
+    packed = array('i', values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+def pack_bits(flags):
+    """
+        Packs booleans into a bitset, least significant bit first.
+    """
+    bits = bytearray((len(flags) + 7) // 8)
+    for index, flag in enumerate(flags):
+        if flag:
+            bits[index >> 3] |= 1 << (index & 7)
+    return bytes(bits)
+
+def encode_agents(step, cars, light_states):
+    """
+        Encodes the cars, given as (id, x, z) tuples, and the states of the
+        lights in index order.
+    """
+    ids = [agent_number(car_id) for car_id, _, _ in cars]
+    return b''.join((
+        HEADER.pack(MAGIC, step, len(cars), len(light_states)),
+        int32_bytes(ids),
+        int32_bytes([x for _, x, _ in cars]),
+        int32_bytes([z for _, _, z in cars]),
+        pack_bits(light_states),
+    ))
+
+def decode_agents(data):
+    """
+        Decodes a packed message into a dictionary with the step, the cars as
+        (id, x, z) tuples and the list of light states (True is green).
+    """
+    magic, step, car_count, light_count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"Not a packed agents message: {magic!r}")
+
+    columns = []
+    offset = HEADER.size
+    for _ in range(3):
+        column = array('i')
+        column.frombytes(data[offset:offset + 4 * car_count])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        columns.append(column)
+        offset += 4 * car_count
+
+    bits = data[offset:offset + (light_count + 7) // 8]
+    lights = [bool(bits[index >> 3] & (1 << (index & 7))) for index in range(light_count)]
+    return {'step': step, 'cars': list(zip(*columns)), 'lights': lights}